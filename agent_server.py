@@ -12,6 +12,13 @@ MCP_SERVER_URL = os.getenv("MCP_SERVER_URL", "https://TU-URL-DEL-SERVICIO-A.run.
 # -----------------------------------------------------------------------------------
 
 # ... (Imports)
+from utilities.agent_memory import BoundedMemorySaver, CachedMCPTools, recortar_historial
+
+# Memoria acotada: LRU/TTL por hilo de correo y poda de checkpoints antiguos
+memory = BoundedMemorySaver()
+
+agent = None
+
 
 async def init_agent():
     mcp_client = MultiServerMCPClient({
@@ -22,20 +29,33 @@ async def init_agent():
         },
     })
 
-    tools = await mcp_client.get_tools()
-    print(f"✅ {len(tools)} herramientas MCP cargadas: {', '.join([t.name for t in tools])}")
+    # Se arranca con los esquemas guardados en disco y un hilo propio los refresca;
+    # el agente solo se reconstruye si el servidor MCP cambia sus tools
+    tools_cache = CachedMCPTools(mcp_client, on_change=lambda tools: reconstruir_agente(tools))
+    tools = tools_cache.load_from_disk()
+    if not tools:
+        # Primer arranque sin esquemas guardados: no queda otra que consultar al servidor
+        tools = await tools_cache.refresh()
+    tools_cache.start_background_refresh()
+    return reconstruir_agente(tools)
+
+
+def reconstruir_agente(tools):
+    global agent
 
-    # Asegúrate de que system_prompt esté alineado con los nombres de tus tools (subir_pdf_easycontact, validar_factura, enviar_factura_a_sheets)
+    # Asegúrate de que system_prompt esté alineado con los nombres de tus tools (procesar_factura_end_to_end, subir_pdf_easycontact, validar_factura, enviar_factura_a_sap)
     system_prompt = """ 
-    Contexto: Eres Sergio un asistente virtual que responde correos electrónicos de facturación en nombre de la empresa Datec. Tu tarea es usar las tools disponibles, para comprobar la validez de sus facturas y luego subirlas a sheets
+    Contexto: Eres Sergio un asistente virtual que responde correos electrónicos de facturación en nombre de la empresa Datec. Tu tarea es usar las tools disponibles, para comprobar la validez de sus facturas y luego cargarlas en SAP
     Instrucciones:
-    1. Si recibes un enlace de adjunto (archivo de easycontact: [URL]), primero usa la tool **subir_pdf_easycontact** para guardar el archivo en GCS.
-    2. Luego, usa la tool **validar_factura** con la ruta GCS.
-    3. Si la factura es válida, usa **enviar_factura_a_sheets**.
+    1. Si recibes un enlace de adjunto (archivo de easycontact: [URL]), usa la tool **procesar_factura_end_to_end** con image_url=[URL] y el correo del remitente. Esta tool sube el archivo, valida la factura y, si es válida, la envía a SAP en una sola llamada.
+    2. Si solo te piden validar, usa **procesar_factura_end_to_end** con enviar_sap=false.
+    3. Usa **subir_pdf_easycontact**, **validar_factura** o **enviar_factura_a_sap** por separado solo para reintentar una etapa concreta.
     4. Responde al usuario de forma clara con el resultado de las acciones.
     """
     
-    agent = create_react_agent(model, tools, checkpointer=memory, system_prompt=system_prompt)
+    # pre_model_hook limita los tokens de historial que se reenvían en cada turno
+    agent = create_react_agent(model, tools, checkpointer=memory, system_prompt=system_prompt,
+                               pre_model_hook=recortar_historial)
     return agent
 
 # ... (El resto del código del Agente Flask, funciones process_message_with_langchain, handle_webhook, etc. se mantiene igual)
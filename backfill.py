@@ -0,0 +1,180 @@
+# backfill.py - Carga masiva de facturas históricas (prefijo GCS o directorio local)
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from tool import validar_factura_tool, enviar_factura_a_sap_tool
+from utilities.image_storage import storage_client, BUCKET_NAME, download_pdf_to_tempfile, download_pdf_to_tempfile_local
+from utilities.logging_config import configure_logging, correlacion
+
+logger = logging.getLogger(__name__)
+
+# Estados que no se vuelven a procesar al reanudar
+ESTADOS_FINALES = ("success", "invalida")
+
+
+def listar_pdfs_gcs(origen):
+    """Rutas de blobs PDF bajo un prefijo ('gs://bucket/prefijo' o 'prefijo' en BUCKET_NAME)."""
+    if origen.startswith("gs://"):
+        bucket_name, _, prefijo = origen[len("gs://"):].partition("/")
+    else:
+        bucket_name, prefijo = BUCKET_NAME, origen
+
+    if bucket_name != BUCKET_NAME:
+        raise ValueError(f"Solo se admite el bucket configurado ({BUCKET_NAME}), no {bucket_name}")
+
+    for blob in storage_client.list_blobs(bucket_name, prefix=prefijo):
+        if blob.name.lower().endswith(".pdf"):
+            yield blob.name
+
+
+def listar_pdfs_locales(directorio):
+    for raiz, _, archivos in os.walk(directorio):
+        for nombre in sorted(archivos):
+            if nombre.lower().endswith(".pdf"):
+                yield os.path.join(raiz, nombre)
+
+
+class Manifiesto:
+    """
+    Registro JSONL de los archivos procesados. Cada línea es el último
+    resultado de un archivo; al reanudar se omiten los que ya terminaron.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.estados = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for linea in f:
+                    try:
+                        entrada = json.loads(linea)
+                    except ValueError:
+                        continue
+                    self.estados[entrada["archivo"]] = entrada["status"]
+
+    def procesado(self, archivo):
+        return self.estados.get(archivo) in ESTADOS_FINALES
+
+    def registrar(self, entrada):
+        with self._lock:
+            self.estados[entrada["archivo"]] = entrada["status"]
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entrada, ensure_ascii=False, default=str) + "\n")
+
+
+def procesar_archivo(archivo, local, enviar_sap, correo):
+    """Descarga → OCR → extracción → SAP para un archivo; devuelve la entrada del manifiesto."""
+    inicio = time.monotonic()
+    entrada = {"archivo": archivo, "status": "error", "ts": datetime.now().isoformat()}
+
+    with correlacion():
+        descargar = download_pdf_to_tempfile_local if local else download_pdf_to_tempfile
+        validacion = validar_factura_tool([archivo], descargar=descargar)
+
+        if validacion.get("status") != "success":
+            entrada["error"] = validacion.get("error")
+        else:
+            datos = validacion["datos"]
+            entrada["numero_factura"] = datos.get("numero_factura")
+            entrada["nit_factura"] = datos.get("nit_factura")
+            entrada["monto_total"] = datos.get("monto_total")
+
+            if not datos.get("factura_valida"):
+                entrada["status"] = "invalida"
+            elif not enviar_sap:
+                entrada["status"] = "success"
+            else:
+                resultado_sap = enviar_factura_a_sap_tool(datos, correo)
+                if resultado_sap.get("status") == "success":
+                    entrada["status"] = "success"
+                    entrada["factura_id"] = resultado_sap["data"].get("factura_id")
+                else:
+                    entrada["error"] = resultado_sap.get("error") or resultado_sap.get("message")
+
+    entrada["segundos"] = round(time.monotonic() - inicio, 2)
+    return entrada
+
+
+def formatear_duracion(segundos):
+    segundos = int(segundos)
+    return f"{segundos // 3600:02d}:{segundos % 3600 // 60:02d}:{segundos % 60:02d}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Procesa en lote facturas PDF históricas.")
+    parser.add_argument("origen", help="gs://bucket/prefijo, prefijo dentro de BUCKET_NAME o directorio local")
+    parser.add_argument("--manifiesto", default="backfill_manifest.jsonl", help="archivo JSONL para reanudar")
+    parser.add_argument("--workers", type=int, default=4, help="facturas procesadas en paralelo")
+    parser.add_argument("--sin-sap", action="store_true", help="solo valida, no envía a SAP")
+    parser.add_argument("--correo", default="backfill@datec.com.bo", help="correo registrado como remitente")
+    parser.add_argument("--limite", type=int, default=0, help="máximo de archivos a procesar (0 = todos)")
+    args = parser.parse_args(argv)
+
+    configure_logging()
+
+    local = os.path.isdir(args.origen)
+    archivos = listar_pdfs_locales(args.origen) if local else listar_pdfs_gcs(args.origen)
+    manifiesto = Manifiesto(args.manifiesto)
+
+    pendientes = [a for a in archivos if not manifiesto.procesado(a)]
+    if args.limite:
+        pendientes = pendientes[:args.limite]
+    total = len(pendientes)
+    print(f"{total} archivos pendientes ({len(manifiesto.estados)} ya registrados en {args.manifiesto})",
+          file=sys.stderr)
+
+    inicio = time.monotonic()
+    conteo = {"success": 0, "invalida": 0, "error": 0}
+    hechos = 0
+
+    # Como máximo 2 * workers trabajos en vuelo para no materializar miles de futures
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        restantes = iter(pendientes)
+        en_vuelo = {}
+
+        def llenar():
+            while len(en_vuelo) < 2 * args.workers:
+                archivo = next(restantes, None)
+                if archivo is None:
+                    return
+                futuro = pool.submit(procesar_archivo, archivo, local, not args.sin_sap, args.correo)
+                en_vuelo[futuro] = archivo
+
+        llenar()
+        while en_vuelo:
+            listos, _ = wait(en_vuelo, return_when=FIRST_COMPLETED)
+            for futuro in listos:
+                archivo = en_vuelo.pop(futuro)
+                try:
+                    entrada = futuro.result()
+                except Exception as e:
+                    logger.error(f"Error inesperado en backfill de {archivo}: {e}")
+                    entrada = {"archivo": archivo, "status": "error", "error": str(e),
+                               "ts": datetime.now().isoformat()}
+                manifiesto.registrar(entrada)
+                conteo[entrada["status"]] += 1
+                hechos += 1
+
+                transcurrido = time.monotonic() - inicio
+                por_minuto = hechos / transcurrido * 60 if transcurrido else 0.0
+                eta = (total - hechos) / (hechos / transcurrido) if hechos else 0
+                print(f"[{hechos}/{total}] {por_minuto:.1f} facturas/min | ETA {formatear_duracion(eta)} | "
+                      f"ok={conteo['success']} invalidas={conteo['invalida']} errores={conteo['error']} | "
+                      f"{entrada['archivo']}: {entrada['status']}",
+                      file=sys.stderr, flush=True)
+            llenar()
+
+    print(f"Terminado en {formatear_duracion(time.monotonic() - inicio)}: {conteo}", file=sys.stderr)
+    return 0 if conteo["error"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
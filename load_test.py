@@ -0,0 +1,159 @@
+# load_test.py - Generador de carga escalonada para las tools del servidor MCP
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+from fastmcp import Client
+
+
+def percentil(valores, p):
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(len(ordenados) * p))]
+
+
+def contenido_json(resultado):
+    """Primer bloque de texto de la respuesta de una tool, decodificado como JSON."""
+    bloques = getattr(resultado, "content", resultado)
+    for bloque in bloques:
+        texto = getattr(bloque, "text", None)
+        if texto:
+            try:
+                return json.loads(texto)
+            except ValueError:
+                return texto
+    return None
+
+
+async def trabajador(url, tool, argumentos, cola, latencias, errores):
+    async with Client(url) as client:
+        while True:
+            try:
+                cola.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            inicio = time.perf_counter()
+            try:
+                resultado = contenido_json(await client.call_tool(tool, argumentos))
+                if isinstance(resultado, dict) and resultado.get("status") == "error":
+                    errores.append(resultado.get("error"))
+                else:
+                    latencias.append(time.perf_counter() - inicio)
+            except Exception as e:
+                errores.append(str(e))
+
+
+async def perfiles_servidor(url, desde=0):
+    """Resumen de perfiles del servidor (vacío si no corre con MCP_PROFILING=true)."""
+    try:
+        async with Client(url) as client:
+            return contenido_json(await client.call_tool("perfiles_servidor", {"desde": desde})) or {}
+    except Exception:
+        return {}
+
+
+async def ejecutar_nivel(url, tool, argumentos, concurrencia, peticiones):
+    antes = await perfiles_servidor(url)
+    cola = asyncio.Queue()
+    for _ in range(peticiones):
+        cola.put_nowait(None)
+
+    latencias, errores = [], []
+    inicio = time.perf_counter()
+    await asyncio.gather(*(trabajador(url, tool, argumentos, cola, latencias, errores)
+                           for _ in range(concurrencia)))
+    duracion = time.perf_counter() - inicio
+
+    perfil = await perfiles_servidor(url, antes.get("registros", 0))
+    perfil_tool = perfil.get("tools", {}).get(f"{tool}_tool", {})
+    return {
+        "concurrencia": concurrencia,
+        "peticiones": peticiones,
+        "duracion_s": round(duracion, 2),
+        "throughput_rps": round(len(latencias) / duracion, 3) if duracion else 0.0,
+        "latencia_p50_s": percentil(latencias, 0.50),
+        "latencia_p95_s": percentil(latencias, 0.95),
+        "tasa_error": round(len(errores) / peticiones, 3) if peticiones else 0.0,
+        "errores_ejemplo": errores[:3],
+        # Servidor más workers del pool, donde se rasterizan las páginas
+        "servidor_rss_maximo_mb": perfil.get("rss_total_maximo_mb"),
+        "servidor_rss_workers_maximo_mb": perfil.get("rss_workers_maximo_mb"),
+        "servidor_pico_python_mb": perfil_tool.get("pico_python_mb"),
+        "servidor_temporales_sin_borrar": perfil_tool.get("temporales_sin_borrar"),
+    }
+
+
+async def main_async(args):
+    argumentos = json.loads(args.argumentos)
+    if not any(argumentos.values()):
+        # Con argumentos vacíos la tool no descarga, ni hace OCR ni llama al modelo
+        raise SystemExit("--argumentos debe incluir al menos un documento para que la carga sea representativa")
+    if not args.usar_checkpoints:
+        # Todas las llamadas repiten las mismas rutas: con checkpoints, desde la segunda
+        # solo se mediría la lectura del JSON guardado y no el pipeline completo
+        argumentos["usar_checkpoints"] = False
+    niveles = [int(n) for n in args.niveles.split(",")]
+    resultados = []
+    capacidad = None
+
+    for concurrencia in niveles:
+        peticiones = max(args.peticiones_por_nivel, concurrencia)
+        print(f"Nivel de concurrencia {concurrencia} ({peticiones} peticiones)...", file=sys.stderr)
+        nivel = await ejecutar_nivel(args.url, args.tool, argumentos, concurrencia, peticiones)
+        resultados.append(nivel)
+        print(json.dumps(nivel, ensure_ascii=False), file=sys.stderr)
+
+        dentro_slo = (nivel["tasa_error"] <= args.error_max
+                      and nivel["latencia_p95_s"] is not None
+                      and nivel["latencia_p95_s"] <= args.p95_max)
+        memoria_ok = (args.memoria_max_mb is None or nivel["servidor_rss_maximo_mb"] is None
+                      or nivel["servidor_rss_maximo_mb"] <= args.memoria_max_mb)
+        if dentro_slo and memoria_ok:
+            capacidad = concurrencia
+        else:
+            print("Fuera de los límites, se detiene la escalada", file=sys.stderr)
+            break
+
+    reporte = {
+        "url": args.url,
+        "tool": args.tool,
+        "checkpoints": ("activados (--usar-checkpoints): las llamadas repetidas reutilizan la validación guardada"
+                        if args.usar_checkpoints else "desactivados (usar_checkpoints=False en cada llamada)"),
+        "limites": {"p95_max_s": args.p95_max, "error_max": args.error_max, "memoria_max_mb": args.memoria_max_mb},
+        "capacidad_concurrente": capacidad,
+        "niveles": resultados,
+    }
+    with open(args.reporte, "w", encoding="utf-8") as f:
+        json.dump(reporte, f, ensure_ascii=False, indent=2)
+
+    print(f"\n{'conc':>5} {'rps':>8} {'p50 s':>8} {'p95 s':>8} {'error':>6} {'RSS MB':>8}")
+    for n in resultados:
+        print(f"{n['concurrencia']:>5} {n['throughput_rps']:>8} {n['latencia_p50_s'] or '-':>8} "
+              f"{n['latencia_p95_s'] or '-':>8} {n['tasa_error']:>6} {n['servidor_rss_maximo_mb'] or '-':>8}")
+    print(f"\nCapacidad estimada: {capacidad} llamadas concurrentes a '{args.tool}' (reporte en {args.reporte})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prueba de carga escalonada de una tool MCP.")
+    parser.add_argument("--url", default="http://localhost:8080/mcp", help="endpoint streamable-http del servidor")
+    parser.add_argument("--tool", default="validar_factura")
+    parser.add_argument("--argumentos", required=True,
+                        help='argumentos de la tool en JSON, con documentos reales '
+                             '(p. ej. \'{"rutas_bucket": ["facturas/muestra.pdf"]}\'); '
+                             'cada llamada registra su resultado en el almacén de resultados')
+    parser.add_argument("--niveles", default="1,2,4,8,16", help="concurrencias a probar, separadas por coma")
+    parser.add_argument("--peticiones-por-nivel", type=int, default=20)
+    parser.add_argument("--p95-max", type=float, default=60.0, help="latencia p95 máxima aceptable (s)")
+    parser.add_argument("--error-max", type=float, default=0.02, help="tasa de error máxima aceptable")
+    parser.add_argument("--memoria-max-mb", type=float, default=None, help="RSS máximo aceptable del servidor")
+    parser.add_argument("--usar-checkpoints", action="store_true",
+                        help="no desactivar los checkpoints del servidor (mide la ruta de reintento, no el pipeline)")
+    parser.add_argument("--reporte", default="capacity_report.json")
+    asyncio.run(main_async(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
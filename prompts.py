@@ -56,3 +56,37 @@ def get_invoice_text_parser_prompt(invoice_text):
 
     return system_prompt, user_prompt
 
+
+
+def get_invoice_validation_prompt(invoice_text):
+    """
+    Genera un prompt para que el agente de OpenAI valide una factura boliviana y
+    extraiga sus datos desde el texto OCR, con los campos que devuelve validar_factura_tool.
+    """
+    system_prompt = (
+        "Eres un asistente experto en facturación boliviana. Recibirás el texto completo de una factura "
+        "obtenido por OCR y debes validarla y extraer los siguientes campos en un JSON válido:\n"
+        "- empresa_emisora (Razón social de quien emite la factura)\n"
+        "- nit_factura (NIT del emisor)\n"
+        "- numero_factura (Número de factura)\n"
+        "- codigo_autorizacion (Código de autorización o CUF)\n"
+        "- razon_social_cliente\n"
+        "- nit_ci_ce_cliente (NIT/CI/CE del cliente)\n"
+        "- codigo_cliente\n"
+        "- fecha_emision (en formato YYYY-MM-DD)\n"
+        "- direccion\n"
+        "- ciudad\n"
+        "- subtotal\n"
+        "- monto_total (Importe total a pagar)\n"
+        "- productos: Lista de productos con codigo, producto, cantidad, precio_unitario, descuento, subtotal\n"
+        "- factura_valida: true si el texto corresponde a una factura completa y coherente "
+        "(la suma de los productos coincide con el subtotal y el total), false en otro caso\n"
+        "- vigente: true si la factura no indica estar anulada ni vencida\n"
+        "Escribe los montos y cantidades como números, sin símbolo de moneda. "
+        "Si un campo de texto no aparece en la factura usa \"No detectado\". "
+        "Devuelve solo el JSON, sin texto adicional."
+    )
+
+    user_prompt = f"Texto de la factura:\n{invoice_text}\nValida la factura y extrae los datos solicitados en formato JSON."
+
+    return system_prompt, user_prompt
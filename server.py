@@ -1,18 +1,59 @@
 # server.py - Servicio A: Servidor de Tools/MCP
 
 import asyncio
+import json
 import logging
 import os
-from fastmcp import FastMCP
-from tool import validar_factura_tool, enviar_factura_a_sap_tool
+from fastmcp import FastMCP, Context
+from tool import validar_factura_tool, enviar_factura_a_sap_tool, procesar_factura_end_to_end_tool
 from utilities.image_storage import upload_image_to_gcs
+from utilities.general import get_llm_usage_stats
+from utilities.workers import warm_process_pool, shutdown_process_pool
+from utilities.logging_config import configure_logging, correlacion, log_payload
+from utilities.profiling import perfilar, resumen_perfiles
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(format="[%(levelname)s]: %(message)s", level=logging.INFO)
+configure_logging()
 
 # Crear servidor MCP
 mcp = FastMCP("MCP Server S4HANA Tools")
 
+
+class ReportadorProgreso:
+    """
+    Callback de progreso para las funciones de tool.py, que corren en un hilo
+    aparte. Reenvía cada notificación al cliente MCP como progress notification
+    y como mensaje de log con los resultados parciales (p. ej. texto OCR por página).
+    """
+
+    def __init__(self, ctx: Context):
+        self.ctx = ctx
+        self.loop = asyncio.get_running_loop()
+        self.futuros = []
+
+    def __call__(self, etapa, actual, total, datos=None):
+        mensaje = json.dumps({"etapa": etapa, "progreso": actual, "total": total, **(datos or {})},
+                             ensure_ascii=False, default=str)
+        self.futuros.append(asyncio.run_coroutine_threadsafe(self.ctx.report_progress(actual, total), self.loop))
+        self.futuros.append(asyncio.run_coroutine_threadsafe(self.ctx.info(mensaje), self.loop))
+
+    async def esperar(self):
+        """Espera a que todas las notificaciones pendientes se hayan enviado."""
+        await asyncio.gather(*(asyncio.wrap_future(f) for f in self.futuros), return_exceptions=True)
+
+
+async def ejecutar_con_progreso(ctx: Context, funcion, *args, **kwargs):
+    """
+    Ejecuta una función bloqueante de tool.py en un hilo, emitiendo su progreso por ctx.
+    Todo lo que se registre durante la llamada lleva el mismo ID de correlación.
+    """
+    reportador = ReportadorProgreso(ctx)
+    with correlacion():
+        try:
+            return await asyncio.to_thread(perfilar(funcion.__name__, funcion), *args, progreso=reportador, **kwargs)
+        finally:
+            await reportador.esperar()
+
 # ------------------------------
 # 1. TOOL: Subir PDF desde EasyContact a GCS
 # ------------------------------
@@ -29,10 +70,11 @@ def subir_pdf_easycontact(user_email: str, image_url: str) -> str:
 # 2. TOOL: Validar Factura
 # ------------------------------
 @mcp.tool()
-def validar_factura(rutas_bucket: list[str]) -> dict:
+async def validar_factura(rutas_bucket: list[str], ctx: Context, usar_checkpoints: bool = True) -> dict:
     logger.info(f"Tool: 'validar_factura' called with rutas_bucket={rutas_bucket}")
-    resultado = validar_factura_tool(rutas_bucket)
-    logger.info(f"Resultado: {resultado}")
+    resultado = await ejecutar_con_progreso(ctx, validar_factura_tool, rutas_bucket,
+                                            usar_checkpoints=usar_checkpoints)
+    log_payload(logger, f"Resultado de validación: {resultado.get('status')}", resultado)
     return resultado
 
 
@@ -40,15 +82,72 @@ def validar_factura(rutas_bucket: list[str]) -> dict:
 # 3. TOOL: Enviar Factura a SAP S/4HANA
 # ------------------------------
 @mcp.tool()
-def enviar_factura_a_sap(datos_factura: dict, correo_remitente: str) -> dict:
+async def enviar_factura_a_sap(datos_factura: dict, correo_remitente: str, ctx: Context) -> dict:
     logger.info(f"Tool: 'enviar_factura_a_sap' llamada para el correo={correo_remitente}")
-    resultado_sap = enviar_factura_a_sap_tool(datos_factura, correo_remitente)
+    resultado_sap = await ejecutar_con_progreso(ctx, enviar_factura_a_sap_tool, datos_factura, correo_remitente)
     return resultado_sap
 
 
 
 # ------------------------------
-# 4. TOOL: Tool de prueba para testing
+# 4. TOOL: Procesar factura de punta a punta (ingesta → validación → SAP)
+# ------------------------------
+@mcp.tool()
+async def procesar_factura_end_to_end(ctx: Context,
+                                correo_remitente: str,
+                                image_url: str | None = None,
+                                rutas_bucket: list[str] | None = None,
+                                validar: bool = True,
+                                enviar_sap: bool = True,
+                                datos_factura: dict | None = None,
+                                usar_checkpoints: bool = True) -> dict:
+    """
+    Procesa una factura completa en una sola llamada: sube el adjunto a GCS
+    (si se indica image_url), la valida y, si es válida, la envía a SAP.
+    Devuelve un resumen compacto del resultado de cada etapa.
+    """
+    logger.info(f"Tool: 'procesar_factura_end_to_end' llamada para el correo={correo_remitente}")
+    resumen = await ejecutar_con_progreso(
+        ctx,
+        procesar_factura_end_to_end_tool,
+        correo_remitente,
+        image_url=image_url,
+        rutas_bucket=rutas_bucket,
+        validar=validar,
+        enviar_sap=enviar_sap,
+        datos_factura=datos_factura,
+        usar_checkpoints=usar_checkpoints
+    )
+    log_payload(logger, f"Resumen: {resumen.get('status')} (etapas: {resumen.get('etapas')})", resumen)
+    return resumen
+
+
+# ------------------------------
+# 5. TOOL: Estadísticas de uso de OpenAI
+# ------------------------------
+@mcp.tool()
+def estadisticas_llm() -> dict:
+    """
+    Devuelve tokens, latencia y escalamientos de modelo acumulados en este
+    proceso, por punto de llamada (text_parser, invoice_validator) y modelo.
+    """
+    return get_llm_usage_stats()
+
+
+# ------------------------------
+# 6. TOOL: Perfiles de memoria/CPU (solo con MCP_PROFILING=true)
+# ------------------------------
+@mcp.tool()
+def perfiles_servidor(desde: int = 0) -> dict:
+    """
+    Resumen de las invocaciones perfiladas desde el índice indicado: duración
+    p50/p95, pico de memoria Python, RSS máximo y temporales sin borrar por tool.
+    """
+    return resumen_perfiles(desde)
+
+
+# ------------------------------
+# 7. TOOL: Tool de prueba para testing
 # ------------------------------
 @mcp.tool()
 def tool_prueba(nombre: str) -> str:
@@ -70,10 +169,15 @@ def tool_prueba(nombre: str) -> str:
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8080))
     logger.info(f"MCP server started on port {port}")
-    asyncio.run(
-        mcp.run_async(
-            transport="streamable-http",
-            host="0.0.0.0",
-            port=port
+    # Arranca los workers CPU antes de recibir tráfico
+    warm_process_pool()
+    try:
+        asyncio.run(
+            mcp.run_async(
+                transport="streamable-http",
+                host="0.0.0.0",
+                port=port
+            )
         )
-    )
+    finally:
+        shutdown_process_pool()
@@ -0,0 +1,41 @@
+from datetime import date
+
+from utilities.parsing import parsear_monto, parsear_fecha
+
+
+def test_parsear_monto_separadores_de_miles():
+    assert parsear_monto("12.500") == 12500.0
+    assert parsear_monto("1.250.000") == 1250000.0
+    assert parsear_monto("12,500") == 12500.0
+    assert parsear_monto("1.234,50") == 1234.5
+    assert parsear_monto("1,234.50") == 1234.5
+
+
+def test_parsear_monto_decimales():
+    assert parsear_monto("150.00") == 150.0
+    assert parsear_monto("1,5") == 1.5
+    assert parsear_monto("0.500") == 0.5
+    assert parsear_monto("0,750") == 0.75
+
+
+def test_parsear_monto_con_moneda():
+    assert parsear_monto("Bs. 150.00") == 150.0
+    assert parsear_monto("Bs 1,234.50") == 1234.5
+    assert parsear_monto("BOB 12.500") == 12500.0
+    assert parsear_monto("150.00 Bs.") == 150.0
+
+
+def test_parsear_monto_sin_numero():
+    assert parsear_monto("No detectado") == 0.0
+    assert parsear_monto("No detectado", por_defecto=None) is None
+    assert parsear_monto(None) == 0.0
+    assert parsear_monto(42) == 42.0
+
+
+def test_parsear_fecha():
+    assert parsear_fecha("15/03/2024") == date(2024, 3, 15)
+    assert parsear_fecha("15.03.2024") == date(2024, 3, 15)
+    assert parsear_fecha("15 de marzo de 2024") == date(2024, 3, 15)
+    assert parsear_fecha("2024-03-15T00:00:00") == date(2024, 3, 15)
+    assert parsear_fecha("No detectada") is None
+    assert parsear_fecha("") is None
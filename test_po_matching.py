@@ -0,0 +1,120 @@
+import time
+
+from utilities.po_matching import PurchaseOrderIndex, PurchaseOrderIndexCache
+
+
+def posicion(po, item, cantidad, precio, material="", facturado=None):
+    datos = {
+        "PurchaseOrder": po,
+        "PurchaseOrderItem": item,
+        "Material": material,
+        "OrderQuantity": str(cantidad),
+        "NetPriceAmount": str(precio),
+        "NetPriceQuantity": "1",
+        "DocumentCurrency": "BOB",
+    }
+    if facturado is not None:
+        datos["InvoicedQuantity"] = facturado
+    return datos
+
+
+def test_match_por_codigo_de_producto():
+    indice = PurchaseOrderIndex([
+        posicion("4500000001", "00010", 10, 50.0, material="MAT-A"),
+        posicion("4500000001", "00020", 5, 200.0, material="MAT-B"),
+    ])
+    items = [{"ProductCode": "mat-b", "Quantity": 2, "UnitPrice": 200.0, "Subtotal": 400.0}]
+
+    referencias = indice.match(items, 400.0)
+
+    assert len(referencias) == 1
+    assert referencias[0]["PurchaseOrderItem"] == "00020"
+    assert referencias[0]["Amount"] == 400.0
+    assert referencias[0]["Quantity"] == 2
+
+
+def test_match_una_posicion_por_monto_total():
+    indice = PurchaseOrderIndex([
+        posicion("4500000001", "00010", 1, 1000.0),
+        posicion("4500000002", "00010", 1, 2500.0),
+    ])
+
+    referencias = indice.match([], 2500.0)
+
+    assert [r["PurchaseOrder"] for r in referencias] == ["4500000002"]
+
+
+def test_match_combinacion_de_posiciones():
+    indice = PurchaseOrderIndex([
+        posicion("4500000001", "00010", 1, 700.0),
+        posicion("4500000001", "00020", 1, 450.0),
+        posicion("4500000002", "00010", 1, 300.0),
+        posicion("4500000003", "00010", 1, 125.0),
+    ])
+
+    referencias = indice.match([], 1125.0)
+
+    assert sorted(r["Amount"] for r in referencias) == [125.0, 300.0, 700.0]
+    assert round(sum(r["Amount"] for r in referencias), 2) == 1125.0
+
+
+def test_match_descuenta_lo_ya_facturado():
+    indice = PurchaseOrderIndex([
+        posicion("4500000001", "00010", 10, 100.0, facturado=6),
+        posicion("4500000001", "00020", 4, 100.0, facturado=4),
+    ])
+
+    assert len(indice) == 1
+    # Solo quedan 4 unidades abiertas (400 BOB): una factura de 1000 no cabe en la posición
+    assert indice.match([], 1000.0) == []
+    referencias = indice.match([], 400.0)
+    assert referencias[0]["Quantity"] == 4
+    assert referencias[0]["Amount"] == 400.0
+
+
+def test_match_sin_cobertura_devuelve_vacio():
+    indice = PurchaseOrderIndex([posicion("4500000001", "00010", 1, 100.0)])
+
+    assert indice.match([], 5000.0) == []
+
+
+def test_match_total_acotado_con_muchas_posiciones():
+    lineas = [posicion(f"45000{n:05d}", "00010", 1, 1000.0 + 1237.0 * n) for n in range(40)]
+    indice = PurchaseOrderIndex(lineas)
+
+    inicio = time.monotonic()
+    assert indice.match([], 5_000_000.0) == []
+    objetivo = 1000.0 + 1237.0 * 3 + 1000.0 + 1237.0 * 17 + 1000.0 + 1237.0 * 29
+    referencias = indice.match([], objetivo + 0.37)
+    assert time.monotonic() - inicio < 5
+
+    assert referencias
+    assert abs(sum(r["Amount"] for r in referencias) - objetivo) <= objetivo * 0.01
+
+
+def test_match_cuadra_con_el_total_de_la_factura():
+    indice = PurchaseOrderIndex([
+        posicion("4500000001", "00010", 1, 700.0),
+        posicion("4500000001", "00020", 1, 300.0),
+    ])
+    items = [
+        {"ProductCode": "", "Quantity": 1, "UnitPrice": 700.0, "Subtotal": 700.0},
+        {"ProductCode": "", "Quantity": 1, "UnitPrice": 300.0, "Subtotal": 300.0},
+    ]
+
+    for referencias, total in ((indice.match([], 1004.5), 1004.5), (indice.match(items, 1003.2), 1003.2)):
+        assert round(sum(r["Amount"] for r in referencias), 2) == total
+
+
+def test_cache_no_guarda_fallos_de_carga():
+    cache = PurchaseOrderIndexCache(ttl=300)
+    llamadas = []
+
+    def loader(supplier_code):
+        llamadas.append(supplier_code)
+        return None if len(llamadas) == 1 else [posicion("4500000001", "00010", 1, 100.0)]
+
+    assert cache.get("100001", loader) is None
+    assert len(cache.get("100001", loader)) == 1
+    assert len(cache.get("100001", loader)) == 1
+    assert len(llamadas) == 2
@@ -1,14 +1,20 @@
 # tool.py - Módulo de herramientas para procesamiento de facturas SAP
 
+import os
 import json
 import logging
 import requests
 from datetime import datetime
 from requests.auth import HTTPBasicAuth
-from utilities.general import get_openai_answer, get_clean_json
-from utilities.image_storage import download_pdf_to_tempfile
-from utilities.general import get_transcript_document_cloud_vision
-from prompts import get_invoice_validator_prompt, get_invoice_text_parser_prompt
+from utilities.general import get_openai_json_answer
+from utilities.image_storage import download_pdf_to_tempfile, upload_image_to_gcs
+from utilities.general import get_transcript_document_routed
+from utilities.checkpoints import get_checkpoint_store, checkpoint_key
+from utilities.po_matching import po_index_cache, to_float
+from utilities.logging_config import log_payload
+from utilities.result_store import registrar_resultado
+from utilities.parsing import parsear_monto, parsear_fecha
+from prompts import get_invoice_validation_prompt, get_invoice_text_parser_prompt
 
 # Configuración de logging para Google Cloud Run
 logger = logging.getLogger(__name__)
@@ -19,9 +25,16 @@ SAP_CONFIG = {
     'password': "FJyB@~[NkeSenF5WiMj>7=w+>fuFB~R[xDqjcEni",
     'supplier_url': "https://my408830-api.s4hana.cloud.sap/sap/opu/odata/sap/API_BUSINESS_PARTNER/A_Supplier",
     'purchase_order_url': "https://my408830-api.s4hana.cloud.sap/sap/opu/odata/sap/API_PURCHASEORDER/A_PurchaseOrder",
-    'invoice_post_url': "https://my408830-api.s4hana.cloud.sap/sap/opu/odata/sap/API_SUPPLIERINVOICE_PROCESS_SRV/A_SupplierInvoice"
+    'invoice_post_url': "https://my408830-api.s4hana.cloud.sap/sap/opu/odata/sap/API_SUPPLIERINVOICE_PROCESS_SRV/A_SupplierInvoice",
+    'invoice_po_ref_url': "https://my408830-api.s4hana.cloud.sap/sap/opu/odata/sap/API_SUPPLIERINVOICE_PROCESS_SRV/A_SuplrInvcItemPurOrdRef"
 }
 
+# Órdenes de compra por página y máximo de órdenes recientes que se indexan por proveedor
+PO_PAGE_SIZE = 50
+PO_MAX_ORDERS = int(os.getenv("PO_MAX_ORDERS", 200))
+# Órdenes por consulta de cantidades facturadas (largo máximo de la URL)
+PO_INVOICED_CHUNK = 40
+
 
 # ============================================================================
 # FUNCIONES AUXILIARES
@@ -40,30 +53,44 @@ def safe_json_response(response):
         return None
 
 
+def notificar_progreso(progreso, etapa, actual, total, datos=None):
+    """
+    Invoca el callback de progreso (si existe) sin dejar que un fallo al
+    notificar interrumpa el procesamiento de la factura.
+    """
+    if not progreso:
+        return
+    try:
+        progreso(etapa, actual, total, datos)
+    except Exception as e:
+        logger.warning(f"Error al notificar progreso de la etapa '{etapa}': {e}")
+
+
+def escalar_progreso(progreso, inicio, fin, total):
+    """Adapta un callback de progreso para que una sub-etapa ocupe el tramo [inicio, fin] de total."""
+    if not progreso:
+        return None
+
+    def callback(etapa, actual, sub_total, datos=None):
+        fraccion = actual / sub_total if sub_total else 1.0
+        progreso(etapa, inicio + (fin - inicio) * fraccion, total, datos)
+
+    return callback
+
+
 def format_sap_date(date_str):
-    """Convierte cualquier formato de fecha al requerido por SAP (YYYY-MM-DDT00:00:00)."""
+    """
+    Convierte la fecha de la factura al formato requerido por SAP (YYYY-MM-DDT00:00:00).
+    Devuelve None si no se reconoce, para no registrar la factura con una fecha inventada.
+    """
     if not date_str:
         return None
     
-    date_part = date_str.split("T")[0] if "T" in date_str else date_str
-    
-    date_formats = [
-        "%Y-%m-%d",
-        "%d/%m/%Y",
-        "%m/%d/%Y",
-        "%d-%m-%Y",
-        "%Y/%m/%d",
-    ]
-    
-    for fmt in date_formats:
-        try:
-            dt = datetime.strptime(date_part, fmt)
-            return dt.strftime("%Y-%m-%dT00:00:00")
-        except ValueError:
-            continue
-    
-    logger.warning(f"No se pudo parsear la fecha: {date_str}. Usando fecha actual.")
-    return datetime.now().strftime("%Y-%m-%dT00:00:00")
+    fecha = parsear_fecha(date_str)
+    if fecha is None:
+        logger.warning(f"No se pudo parsear la fecha: {date_str}")
+        return None
+    return fecha.strftime("%Y-%m-%dT00:00:00")
 
 
 def obtener_sesion_con_token():
@@ -109,11 +136,13 @@ def extraer_datos_factura_desde_texto(texto_factura):
     """Extrae datos principales de la factura desde texto OCR usando OpenAI."""
     try:
         system_prompt, user_prompt = get_invoice_text_parser_prompt(texto_factura)
-        raw_result = get_openai_answer(system_prompt, user_prompt)
-        
-        # Limpiar y parsear respuesta
-        raw_result = get_clean_json(raw_result)
-        datos = json.loads(raw_result)
+        datos = get_openai_json_answer(
+            system_prompt,
+            user_prompt,
+            call_site="text_parser",
+            required_fields=("SupplierInvoiceIDByInvcgParty", "SupplierName", "DocumentDate", "InvoiceGrossAmount"),
+            validator=lambda d: isinstance(d.get("Items", []), list)
+        )
         
         # Validar y corregir formato de campos críticos
         if "DocumentDate" in datos:
@@ -222,40 +251,125 @@ def buscar_proveedor_en_sap(factura_datos, proveedores_sap):
     return None
 
 
-def obtener_ordenes_compra_proveedor(supplier_code):
-    """Obtiene las órdenes de compra activas para un proveedor específico."""
-    try:
-        headers = {
-            "Accept": "application/json",
-            "Content-Type": "application/json"
-        }
+def obtener_cantidades_facturadas(purchase_orders):
+    """
+    Cantidad ya facturada por posición de OC ({(PurchaseOrder, PurchaseOrderItem): cantidad}),
+    sumando las referencias a OC de las facturas de proveedor registradas en SAP.
+    Devuelve None si no se pudo consultar.
+    """
+    headers = {
+        "Accept": "application/json",
+        "Content-Type": "application/json"
+    }
+    ordenes = sorted(purchase_orders)
+    facturado = {}
+    
+    # Consultas de a PO_INVOICED_CHUNK órdenes para no exceder el largo de URL
+    for inicio in range(0, len(ordenes), PO_INVOICED_CHUNK):
+        filtro = " or ".join(f"PurchaseOrder eq '{po}'" for po in ordenes[inicio:inicio + PO_INVOICED_CHUNK])
+        url = (f"{SAP_CONFIG['invoice_po_ref_url']}?$filter={filtro}"
+               f"&$select=PurchaseOrder,PurchaseOrderItem,QuantityInPurchaseOrderUnit&$top=5000")
+        try:
+            response = requests.get(
+                url,
+                headers=headers,
+                auth=HTTPBasicAuth(SAP_CONFIG['username'], SAP_CONFIG['password']),
+                timeout=30
+            )
+        except Exception as e:
+            logger.error(f"Error al obtener cantidades facturadas de las OC: {e}")
+            return None
         
-        url = f"{SAP_CONFIG['purchase_order_url']}?$filter=Supplier eq '{supplier_code}'&$top=10"
-        response = requests.get(
-            url,
-            headers=headers,
-            auth=HTTPBasicAuth(SAP_CONFIG['username'], SAP_CONFIG['password']),
-            timeout=30
-        )
+        data = safe_json_response(response) if response.status_code == 200 else None
+        if not data or "d" not in data or "results" not in data["d"]:
+            logger.warning(f"No se pudo consultar lo facturado de las OC (Status: {response.status_code})")
+            return None
+        for ref in data["d"]["results"]:
+            clave = (ref.get("PurchaseOrder"), ref.get("PurchaseOrderItem"))
+            facturado[clave] = facturado.get(clave, 0.0) + to_float(ref.get("QuantityInPurchaseOrderUnit"))
+    
+    return facturado
+
+
+def obtener_items_ordenes_compra_proveedor(supplier_code):
+    """
+    Obtiene las posiciones abiertas (no facturadas por completo) de las OC más
+    recientes de un proveedor, con la cantidad ya facturada en InvoicedQuantity.
+    
+    Devuelve None si SAP no respondió (el fallo no debe confundirse con
+    "sin posiciones abiertas" ni quedar en caché) y [] si no hay posiciones abiertas.
+    """
+    headers = {
+        "Accept": "application/json",
+        "Content-Type": "application/json"
+    }
+    items = []
+    
+    # Las OC más recientes primero, paginando hasta PO_MAX_ORDERS órdenes
+    for skip in range(0, PO_MAX_ORDERS, PO_PAGE_SIZE):
+        url = (f"{SAP_CONFIG['purchase_order_url']}?$filter=Supplier eq '{supplier_code}'"
+               f"&$expand=to_PurchaseOrderItem&$orderby=PurchaseOrderDate desc,PurchaseOrder desc"
+               f"&$top={PO_PAGE_SIZE}&$skip={skip}")
+        try:
+            response = requests.get(
+                url,
+                headers=headers,
+                auth=HTTPBasicAuth(SAP_CONFIG['username'], SAP_CONFIG['password']),
+                timeout=30
+            )
+        except Exception as e:
+            logger.error(f"Error al obtener posiciones de órdenes de compra: {e}")
+            return None
         
-        if response.status_code == 200:
-            data = safe_json_response(response)
-            if data and "d" in data and "results" in data["d"]:
-                oc_list = data["d"]["results"]
-                if oc_list:
-                    logger.info(f"{len(oc_list)} órdenes de compra encontradas para proveedor {supplier_code}")
-                    return oc_list
-                else:
-                    logger.warning(f"No se encontraron órdenes de compra para el proveedor {supplier_code}")
-            else:
-                logger.warning("No se encontraron datos de órdenes de compra en la respuesta")
-        else:
+        if response.status_code != 200:
             logger.warning(f"No se pudo acceder a API de órdenes de compra (Status: {response.status_code})")
-            
-    except Exception as e:
-        logger.error(f"Error al obtener órdenes de compra: {e}")
+            return None
+        data = safe_json_response(response)
+        if not data or "d" not in data or "results" not in data["d"]:
+            logger.warning("No se encontraron datos de órdenes de compra en la respuesta")
+            return None
+        
+        ordenes = data["d"]["results"]
+        for oc in ordenes:
+            for item in oc.get("to_PurchaseOrderItem", {}).get("results", []):
+                if item.get("IsFinallyInvoiced") or item.get("PurchasingDocumentDeletionCode"):
+                    continue
+                item.setdefault("DocumentCurrency", oc.get("DocumentCurrency"))
+                items.append(item)
+        if len(ordenes) < PO_PAGE_SIZE:
+            break
     
-    return []
+    # Las posiciones parcialmente facturadas solo tienen abierto el resto
+    facturado = obtener_cantidades_facturadas({i.get("PurchaseOrder") for i in items})
+    if facturado is None:
+        return None
+    for item in items:
+        item["InvoicedQuantity"] = facturado.get((item.get("PurchaseOrder"), item.get("PurchaseOrderItem")), 0.0)
+    
+    logger.info(f"{len(items)} posiciones de OC abiertas para proveedor {supplier_code}")
+    return items
+
+
+def emparejar_ordenes_compra(supplier_code, factura_datos):
+    """
+    Elige las posiciones de OC que cubren la factura usando el índice de
+    posiciones abiertas del proveedor. Devuelve referencias con monto y cantidad
+    por posición, listas para construir_json_factura_sap, o None si no se
+    pudieron consultar las OC en SAP.
+    """
+    indice = po_index_cache.get(supplier_code, obtener_items_ordenes_compra_proveedor)
+    if indice is None:
+        return None
+    if not len(indice):
+        logger.warning(f"No se encontraron posiciones de OC abiertas para el proveedor {supplier_code}")
+        return []
+    
+    referencias = indice.match(factura_datos.get("Items", []), parsear_monto(factura_datos.get("InvoiceGrossAmount")))
+    if referencias:
+        logger.info(f"{len(referencias)} posiciones de OC emparejadas de {len(indice)} abiertas")
+    else:
+        logger.warning("Ninguna combinación de posiciones de OC cubre el monto de la factura")
+    return referencias
 
 
 def construir_json_factura_sap(factura_datos, proveedor_info, oc_items):
@@ -297,17 +411,20 @@ def construir_json_factura_sap(factura_datos, proveedor_info, oc_items):
         }
     }
     
-    # Agregar items basados en las OC encontradas
+    # Agregar items basados en las OC encontradas; las referencias emparejadas
+    # traen monto y cantidad por posición, si no se asigna el monto completo
     for idx, oc in enumerate(oc_items, start=1):
+        amount = oc.get("Amount")
+        quantity = oc.get("Quantity", 1.0)
         item = {
             "SupplierInvoiceItem": str(idx).zfill(5),
             "PurchaseOrder": oc.get("PurchaseOrder", ""),
             "PurchaseOrderItem": oc.get("PurchaseOrderItem", "00010"),
-            "DocumentCurrency": "BOB",
-            "QuantityInPurchaseOrderUnit": "1.000",
-            "PurchaseOrderQuantityUnit": "EA",
-            "SupplierInvoiceItemAmount": invoice_amount_str,
-            "TaxCode": "V0"
+            "DocumentCurrency": oc.get("DocumentCurrency", "BOB"),
+            "QuantityInPurchaseOrderUnit": f"{quantity:.3f}",
+            "PurchaseOrderQuantityUnit": oc.get("PurchaseOrderQuantityUnit", "EA"),
+            "SupplierInvoiceItemAmount": f"{amount:.2f}" if amount is not None else invoice_amount_str,
+            "TaxCode": oc.get("TaxCode", "V0")
         }
         factura_json["to_SuplrInvcItemPurOrdRef"]["results"].append(item)
         logger.info(f"Referenciando OC: {oc.get('PurchaseOrder')}, Item: {oc.get('PurchaseOrderItem')}")
@@ -316,11 +433,15 @@ def construir_json_factura_sap(factura_datos, proveedor_info, oc_items):
 
 
 def enviar_factura_a_sap_service(factura_json):
-    """Envía la factura a SAP usando token CSRF y sesión persistente."""
+    """
+    Envía la factura a SAP usando token CSRF y sesión persistente.
+    
+    Retorno: (respuesta de SAP o None, status HTTP o None si la petición no llegó a SAP)
+    """
     session, token = obtener_sesion_con_token()
     if not session or not token:
         logger.error("No se pudo obtener sesión con token válido para SAP")
-        return None
+        return None, None
     
     try:
         headers_post = {
@@ -343,24 +464,73 @@ def enviar_factura_a_sap_service(factura_json):
         if response.status_code in [200, 201]:
             logger.info("Factura creada exitosamente en SAP")
             data = safe_json_response(response)
-            return data
+            return data, response.status_code
         else:
             logger.error(f"Error al crear factura en SAP: {response.status_code}")
             logger.error(f"Detalles: {response.text[:500]}")
-            return None
+            return None, response.status_code
             
     except Exception as e:
         logger.error(f"Error en envío a SAP: {e}")
-        return None
+        return None, None
     finally:
         if session:
             session.close()
 
 
+def mapear_datos_validados_a_sap(datos_factura):
+    """
+    Convierte los datos devueltos por validar_factura_tool al formato que
+    esperan buscar_proveedor_en_sap y construir_json_factura_sap.
+    """
+    def valor(campo):
+        # validar_factura_tool usa "No detectado/a" como marcador de campo ausente
+        v = datos_factura.get(campo)
+        if v is None or str(v).strip().lower().startswith("no detectad"):
+            return ""
+        return v
+    
+    items = []
+    for p in datos_factura.get("productos", []) or []:
+        items.append({
+            "ProductCode": p.get("codigo", ""),
+            "Quantity": parsear_monto(p.get("cantidad")),
+            "Description": p.get("producto", ""),
+            "UnitPrice": parsear_monto(p.get("precio_unitario")),
+            "Discount": parsear_monto(p.get("descuento")),
+            "Subtotal": parsear_monto(p.get("subtotal")),
+        })
+    
+    return {
+        "SupplierInvoiceIDByInvcgParty": str(valor("numero_factura")),
+        "SupplierName": str(valor("empresa_emisora")),
+        "SupplierTaxNumber": str(valor("nit_factura")),
+        "DocumentDate": format_sap_date(valor("fecha_emision")),
+        "InvoiceGrossAmount": parsear_monto(valor("monto_total")),
+        "CustomerName": str(valor("razon_social_cliente")),
+        "CustomerCode": str(valor("codigo_cliente")),
+        "Items": items,
+    }
+
+
 # ============================================================================
 # FUNCIONES PRINCIPALES PARA MCP SERVER
 # ============================================================================
 
+def registrar_resultado_sap(factura_datos, resultado):
+    """Agrega el resultado del envío a SAP al almacén columnar de resultados."""
+    data = resultado.get('data') or {}
+    registrar_resultado(
+        "sap",
+        "success" if resultado.get('success') else "error",
+        documento=factura_datos.get("SupplierInvoiceIDByInvcgParty"),
+        datos=factura_datos,
+        proveedor_codigo=data.get('proveedor_codigo'),
+        factura_id_sap=data.get('factura_id'),
+        error=resultado.get('error')
+    )
+
+
 def procesar_factura_completa(texto_factura):
     """
     FUNCIÓN PRINCIPAL - Procesa una factura desde texto OCR hasta carga en SAP.
@@ -376,36 +546,114 @@ def procesar_factura_completa(texto_factura):
         'data': None,
         'error': None
     }
+    factura_datos = None
     
     try:
         # PASO 1: EXTRACCIÓN DE DATOS DE LA FACTURA
         logger.info("1. EXTRACCIÓN DE DATOS DE FACTURA")
         
-        factura_datos = extraer_datos_factura_desde_texto(texto_factura)
+        checkpoints = get_checkpoint_store()
+        clave = checkpoint_key("texto", texto_factura)
+        factura_datos = checkpoints.get(clave, "extraccion")
+        
+        if factura_datos:
+            logger.info("Datos de factura recuperados de checkpoint, se omite la extracción con OpenAI")
+        else:
+            factura_datos = extraer_datos_factura_desde_texto(texto_factura)
+            if factura_datos:
+                checkpoints.save(clave, "extraccion", factura_datos)
         
         if not factura_datos:
             error_msg = "No se pudieron extraer datos de la factura"
             logger.error(error_msg)
             resultado['error'] = error_msg
+            registrar_resultado_sap({}, resultado)
             return resultado
         
-        logger.info(f"Datos extraídos - Factura: {factura_datos.get('SupplierInvoiceIDByInvcgParty')}")
+    except Exception as e:
+        error_msg = f"Error inesperado en el procesamiento: {str(e)}"
+        logger.error(error_msg)
+        
+        resultado['error'] = error_msg
+        resultado['message'] = "Error en el procesamiento de la factura"
+        registrar_resultado_sap(factura_datos or {}, resultado)
+        
+        return resultado
+    
+    resultado = procesar_factura_desde_datos(factura_datos)
+    registrar_resultado_sap(factura_datos, resultado)
+    return resultado
+
+
+def procesar_factura_desde_datos(factura_datos, progreso=None):
+    """
+    Procesa una factura a partir de datos ya estructurados (formato de
+    extraer_datos_factura_desde_texto) hasta su carga en SAP, sin pasar por OCR ni LLM.
+    
+    Cada etapa (proveedor, órdenes de compra, payload, respuesta de SAP) se guarda
+    como checkpoint del documento; un reintento retoma desde la primera etapa
+    incompleta y nunca vuelve a enviar una factura que SAP ya aceptó. Si SAP
+    rechaza la factura (4xx) se descartan las órdenes de compra y el payload guardados.
+    
+    progreso: callback opcional progreso(etapa, actual, total, datos) por etapa.
+    
+    Retorno:
+    - dict con keys: 'success', 'message', 'data', 'error' (si aplica)
+    """
+    resultado = {
+        'success': False,
+        'message': '',
+        'data': None,
+        'error': None
+    }
+    
+    try:
+        logger.info(f"Datos de factura - Factura: {factura_datos.get('SupplierInvoiceIDByInvcgParty')}")
         logger.info(f"Proveedor: {factura_datos.get('SupplierName')}")
         logger.info(f"Tax: {factura_datos.get('SupplierTaxNumber')}")
-        logger.info(f"Monto: {factura_datos.get('InvoiceGrossAmount', 0):.2f} BOB")
+        monto = parsear_monto(factura_datos.get('InvoiceGrossAmount'))
+        logger.info(f"Monto: {monto or 0:.2f} BOB")
         logger.info(f"Fecha: {factura_datos.get('DocumentDate')}")
         
-        # PASO 2: OBTENCIÓN Y VALIDACIÓN DE PROVEEDOR EN SAP
-        logger.info("2. VALIDACIÓN DE PROVEEDOR EN SAP")
-        
-        proveedores_sap = obtener_proveedores_sap()
-        if not proveedores_sap:
-            error_msg = "No se pudieron obtener proveedores de SAP"
+        # SAP no debe recibir facturas con monto cero ni sin fecha de documento
+        if not monto or monto <= 0 or parsear_fecha(factura_datos.get('DocumentDate')) is None:
+            error_msg = (f"Datos de factura incompletos: monto {factura_datos.get('InvoiceGrossAmount')!r}, "
+                         f"fecha {factura_datos.get('DocumentDate')!r}")
             logger.error(error_msg)
             resultado['error'] = error_msg
+            resultado['message'] = "La factura no se envía a SAP sin monto total y fecha válidos"
             return resultado
         
-        proveedor_info = buscar_proveedor_en_sap(factura_datos, proveedores_sap)
+        checkpoints = get_checkpoint_store()
+        clave = checkpoint_key(
+            "factura",
+            factura_datos.get("SupplierTaxNumber"),
+            factura_datos.get("SupplierName"),
+            factura_datos.get("SupplierInvoiceIDByInvcgParty"),
+            factura_datos.get("DocumentDate"),
+            factura_datos.get("InvoiceGrossAmount"),
+        )
+        etapas = checkpoints.load(clave)
+        if etapas:
+            logger.info(f"Reanudando factura desde checkpoint (etapas completas: {', '.join(etapas)})")
+        
+        # PASO 2: OBTENCIÓN Y VALIDACIÓN DE PROVEEDOR EN SAP
+        notificar_progreso(progreso, "proveedor", 0, 4)
+        logger.info("2. VALIDACIÓN DE PROVEEDOR EN SAP")
+        
+        proveedor_info = etapas.get("proveedor")
+        if not proveedor_info:
+            proveedores_sap = obtener_proveedores_sap()
+            if not proveedores_sap:
+                error_msg = "No se pudieron obtener proveedores de SAP"
+                logger.error(error_msg)
+                resultado['error'] = error_msg
+                return resultado
+            
+            proveedor_info = buscar_proveedor_en_sap(factura_datos, proveedores_sap)
+            if proveedor_info:
+                checkpoints.save(clave, "proveedor", proveedor_info)
+        
         if not proveedor_info:
             error_msg = f"Proveedor no encontrado en SAP: {factura_datos.get('SupplierName')}"
             logger.error(error_msg)
@@ -416,6 +664,7 @@ def procesar_factura_completa(texto_factura):
         logger.info(f"Nombre: {proveedor_info.get('SupplierName')}")
         
         # PASO 3: OBTENCIÓN DE ÓRDENES DE COMPRA ASOCIADAS
+        notificar_progreso(progreso, "ordenes_compra", 1, 4, {"proveedor_codigo": proveedor_info.get("Supplier")})
         logger.info("3. BUSQUEDA DE ÓRDENES DE COMPRA")
         
         supplier_code = proveedor_info.get("Supplier", "")
@@ -425,23 +674,37 @@ def procesar_factura_completa(texto_factura):
             resultado['error'] = error_msg
             return resultado
         
-        oc_items = obtener_ordenes_compra_proveedor(supplier_code)
+        oc_items = etapas.get("ordenes_compra")
+        if not oc_items:
+            oc_items = emparejar_ordenes_compra(supplier_code, factura_datos)
+            if oc_items is None:
+                error_msg = f"No se pudieron consultar las órdenes de compra en SAP para el proveedor {supplier_code}"
+                logger.error(error_msg)
+                resultado['error'] = error_msg
+                return resultado
+            if oc_items:
+                checkpoints.save(clave, "ordenes_compra", oc_items)
         
         # CRÍTICO: Validar que tenemos OC para continuar
         if not oc_items:
-            error_msg = f"No se encontraron órdenes de compra para el proveedor {supplier_code}"
+            error_msg = f"No se encontraron posiciones de órdenes de compra que cubran la factura para el proveedor {supplier_code}"
             logger.error(error_msg)
             logger.error("El proceso se detiene. Esta factura no puede ser cargada sin OC.")
             resultado['error'] = error_msg
             resultado['message'] = "Factura no tiene OC asociada en SAP"
             return resultado
         
-        logger.info(f"{len(oc_items)} órdenes de compra encontradas")
+        logger.info(f"{len(oc_items)} posiciones de órdenes de compra asignadas")
         
         # PASO 4: CONSTRUCCIÓN DEL JSON PARA SAP
+        notificar_progreso(progreso, "construccion_json", 2, 4, {"oc_count": len(oc_items)})
         logger.info("4. CONSTRUCCIÓN DE JSON PARA SAP")
         
-        factura_json = construir_json_factura_sap(factura_datos, proveedor_info, oc_items)
+        factura_json = etapas.get("payload")
+        if not factura_json:
+            factura_json = construir_json_factura_sap(factura_datos, proveedor_info, oc_items)
+            if factura_json:
+                checkpoints.save(clave, "payload", factura_json)
         
         if not factura_json:
             error_msg = "No se pudo construir el JSON para SAP"
@@ -450,9 +713,28 @@ def procesar_factura_completa(texto_factura):
             return resultado
         
         # PASO 5: ENVÍO A SAP
+        notificar_progreso(progreso, "envio_sap", 3, 4)
         logger.info("5. ENVÍO A SAP")
         
-        respuesta_sap = enviar_factura_a_sap_service(factura_json)
+        respuesta_sap = etapas.get("respuesta_sap")
+        if respuesta_sap:
+            logger.info("La factura ya fue aceptada por SAP en un intento anterior, no se reenvía")
+        else:
+            respuesta_sap, status_sap = enviar_factura_a_sap_service(factura_json)
+            if respuesta_sap:
+                checkpoints.save(clave, "respuesta_sap", respuesta_sap)
+                # Las posiciones facturadas ya no están abiertas
+                po_index_cache.invalidate(supplier_code)
+            elif status_sap is not None and 400 <= status_sap < 500:
+                # SAP rechazó el contenido: el reintento debe recalcular las posiciones
+                # de OC y el payload en lugar de reenviar lo mismo. Los fallos
+                # transitorios (token, red, 5xx) sí reutilizan las etapas guardadas.
+                checkpoints.discard(clave, "ordenes_compra", "payload")
+                po_index_cache.invalidate(supplier_code)
+                error_msg = f"SAP rechazó la factura (HTTP {status_sap})"
+                logger.error(error_msg)
+                resultado['error'] = error_msg
+                return resultado
         
         if not respuesta_sap:
             error_msg = "No se pudo enviar la factura a SAP"
@@ -462,6 +744,7 @@ def procesar_factura_completa(texto_factura):
         
         # ÉXITO: Factura cargada correctamente
         logger.info("FACTURA CREADA EXITOSAMENTE EN SAP")
+        notificar_progreso(progreso, "completado", 4, 4)
         
         resultado['success'] = True
         resultado['message'] = "Factura cargada exitosamente en SAP"
@@ -486,37 +769,81 @@ def procesar_factura_completa(texto_factura):
         return resultado
 
 
-def validar_factura_tool(rutas_bucket: list[str]) -> dict:
+def validar_factura_tool(rutas_bucket: list[str], progreso=None, descargar=download_pdf_to_tempfile,
+                         usar_checkpoints: bool = True) -> dict:
     """
     Tool que valida o extrae información de una factura.
     No usa Redis ni Celery, y no envía mensajes externos.
     Devuelve toda la información directamente.
+    
+    descargar: función que copia cada ruta a un archivo temporal local
+    (download_pdf_to_tempfile para GCS, download_pdf_to_tempfile_local para disco).
+    
+    progreso: callback opcional progreso(etapa, actual, total, datos) llamado por
+    etapa (descarga, ocr, openai) y por página de OCR con el texto parcial.
+    
+    La transcripción y el resultado de OpenAI se guardan como checkpoint por ruta,
+    de modo que un reintento no repite la descarga, el OCR ni la llamada al modelo.
+    usar_checkpoints=False ignora y no escribe esos checkpoints (p. ej. en pruebas de
+    carga, que repiten las mismas rutas y deben medir el pipeline completo).
     """
     try:
         logger.info("Iniciando validación de factura")
         resultado_factura = {}
+        total = 3 * len(rutas_bucket)
+        checkpoints = get_checkpoint_store()
 
-        for image in rutas_bucket:
+        for idx, image in enumerate(rutas_bucket):
+            base = 3 * idx
             logger.info(f"Procesando factura: {image}")
-            ruta_temp = download_pdf_to_tempfile(image)
-            logger.info(f"Archivo temporal: {ruta_temp}")
+            clave = checkpoint_key("ruta", image)
+            etapas = checkpoints.load(clave) if usar_checkpoints else {}
+            
+            if "validacion" in etapas:
+                logger.info("Validación recuperada de checkpoint, se omiten descarga, OCR y OpenAI")
+                resultado_factura = etapas["validacion"]
+                continue
+            
+            text_factura = etapas.get("transcripcion")
+            if text_factura:
+                logger.info("Transcripción recuperada de checkpoint, se omiten descarga y OCR")
+            else:
+                notificar_progreso(progreso, "descarga", base, total, {"ruta": image})
+                ruta_temp = descargar(image)
+                logger.info(f"Archivo temporal: {ruta_temp}")
+
+                # OCR
+                logger.info("Extrayendo texto con el enrutador de OCR")
+                notificar_progreso(progreso, "ocr", base + 1, total, {"ruta": image})
 
-            # OCR
-            logger.info("Extrayendo texto con Cloud Vision")
-            text_factura = get_transcript_document_cloud_vision(ruta_temp)
-            logger.info(f"Texto extraído (primeros 2000 caracteres):\n{text_factura[:2000]}")
+                def on_page(pagina, total_paginas, texto, image=image, base=base):
+                    notificar_progreso(progreso, "ocr_pagina", base + 1 + pagina / max(total_paginas, 1), total,
+                                       {"ruta": image, "pagina": pagina, "total_paginas": total_paginas, "texto": texto})
+
+                try:
+                    text_factura = get_transcript_document_routed(ruta_temp, on_page=on_page)
+                finally:
+                    os.remove(ruta_temp)
+                if usar_checkpoints:
+                    checkpoints.save(clave, "transcripcion", text_factura)
+                log_payload(logger, f"Texto extraído ({len(text_factura)} caracteres)", {"ruta": image, "texto": text_factura})
 
             # Prompt para el modelo
             logger.info("Generando prompt para OpenAI")
-            system_prompt, user_prompt = get_invoice_validator_prompt(text_factura)
+            system_prompt, user_prompt = get_invoice_validation_prompt(text_factura)
 
             # Llamada al modelo
             logger.info("Enviando a OpenAI para validación de factura")
-            raw_result = get_openai_answer(system_prompt, user_prompt)
-
-            # Limpiar JSON devuelto
-            logger.info("Procesando resultado JSON")
-            resultado_factura = json.loads(get_clean_json(raw_result))
+            notificar_progreso(progreso, "openai", base + 2, total, {"ruta": image})
+            resultado_factura = get_openai_json_answer(
+                system_prompt,
+                user_prompt,
+                call_site="invoice_validator",
+                required_fields=("numero_factura", "nit_factura", "monto_total"),
+                validator=lambda d: isinstance(d.get("productos", []), list)
+            )
+            if usar_checkpoints:
+                checkpoints.save(clave, "validacion", resultado_factura)
 
         # Extraer campos
         empresa_emisora = resultado_factura.get("empresa_emisora", "No detectada")
@@ -561,7 +888,8 @@ def validar_factura_tool(rutas_bucket: list[str]) -> dict:
                 mensaje += f"    • {p.get('producto', 'N/D')} | Cantidad: {p.get('cantidad', 'N/D')} | Unitario: {p.get('precio_unitario', 'N/D')} | Subtotal: {p.get('subtotal', 'N/D')}\n"
 
         logger.info("Validación de factura completada")
-        return {
+        notificar_progreso(progreso, "completado", total, total)
+        resultado = {
             "status": "success",
             "mensaje": mensaje,
             "datos": {
@@ -582,19 +910,25 @@ def validar_factura_tool(rutas_bucket: list[str]) -> dict:
                 "vigente": vigente
             }
         }
+        registrar_resultado("validacion", "success" if factura_valida else "invalida",
+                            documento=",".join(rutas_bucket), datos=resultado["datos"],
+                            monto_total=parsear_monto(monto_total, por_defecto=None))
+        return resultado
     except Exception as e:
         error_msg = f"Error al validar la factura: {str(e)}"
         logger.error(error_msg)
+        registrar_resultado("validacion", "error", documento=",".join(rutas_bucket), error=str(e))
         return {"status": "error", "error": str(e)}
 
 
-def enviar_factura_a_sap_tool(datos_factura: dict, correo_remitente: str) -> dict:
+def enviar_factura_a_sap_tool(datos_factura: dict, correo_remitente: str, progreso=None) -> dict:
     """
     Envía los datos validados de la factura al sistema SAP S/4HANA.
     
     Parámetros:
         datos_factura: dict con los datos validados de la factura
         correo_remitente: correo que realizó la consulta
+        progreso: callback opcional progreso(etapa, actual, total, datos)
     
     Devuelve:
         dict con el resultado de la operación
@@ -602,17 +936,10 @@ def enviar_factura_a_sap_tool(datos_factura: dict, correo_remitente: str) -> dic
     try:
         logger.info(f"Tool 'enviar_factura_a_sap' llamada para el correo={correo_remitente}")
         
-        # Convertir datos del formato de validación al formato SAP
-        texto_factura = f"""
-        Factura Nº: {datos_factura.get('numero_factura', '')}
-        Proveedor: {datos_factura.get('empresa_emisora', '')}
-        NIT: {datos_factura.get('nit_factura', '')}
-        Fecha: {datos_factura.get('fecha_emision', '')}
-        Monto Total: {datos_factura.get('monto_total', '')}
-        """
-        
-        # Procesar la factura completa
-        resultado = procesar_factura_completa(texto_factura)
+        # Los datos ya vienen validados: se mapean directo al formato SAP sin volver a OpenAI
+        factura_datos = mapear_datos_validados_a_sap(datos_factura)
+        resultado = procesar_factura_desde_datos(factura_datos, progreso=progreso)
+        registrar_resultado_sap(factura_datos, resultado)
         
         if resultado['success']:
             return {
@@ -630,4 +957,107 @@ def enviar_factura_a_sap_tool(datos_factura: dict, correo_remitente: str) -> dic
     except Exception as e:
         error_msg = f"Error en enviar_factura_a_sap_tool: {str(e)}"
         logger.error(error_msg)
-        return {"status": "error", "error": str(e)}
\ No newline at end of file
+        return {"status": "error", "error": str(e)}
+
+def procesar_factura_end_to_end_tool(correo_remitente: str,
+                                     image_url: str | None = None,
+                                     rutas_bucket: list[str] | None = None,
+                                     validar: bool = True,
+                                     enviar_sap: bool = True,
+                                     datos_factura: dict | None = None,
+                                     progreso=None,
+                                     usar_checkpoints: bool = True) -> dict:
+    """
+    Ejecuta en el servidor ingesta → validación → envío a SAP en una sola llamada.
+    
+    Parámetros:
+        correo_remitente: correo que realizó la consulta
+        image_url: URL del adjunto (EasyContact); si se indica, se sube primero a GCS
+        rutas_bucket: rutas GCS ya existentes (alternativa a image_url)
+        validar: ejecutar la etapa de validación (OCR + OpenAI)
+        enviar_sap: ejecutar la etapa de envío a SAP
+        datos_factura: datos ya validados, necesarios si enviar_sap=True y validar=False
+        progreso: callback opcional progreso(etapa, actual, total, datos); cada etapa
+                  ocupa un tercio del progreso total
+        usar_checkpoints: reutilizar los checkpoints de la validación (False en pruebas de carga)
+    
+    Devuelve:
+        dict compacto con el estado de cada etapa ejecutada
+    """
+    resumen = {"status": "error", "etapas": []}
+    
+    try:
+        logger.info(f"Tool 'procesar_factura_end_to_end' llamada para el correo={correo_remitente}")
+        
+        # ETAPA 1: INGESTA
+        rutas = list(rutas_bucket or [])
+        if image_url:
+            notificar_progreso(progreso, "ingesta", 0, 3, {"image_url": image_url})
+            ruta = upload_image_to_gcs(correo_remitente, image_url)
+            if not ruta:
+                resumen["error"] = "Error al subir el archivo."
+                return resumen
+            rutas.append(ruta)
+            resumen["etapas"].append("ingesta")
+        resumen["rutas_bucket"] = rutas
+        
+        # ETAPA 2: VALIDACIÓN
+        if validar:
+            if not rutas:
+                resumen["error"] = "No se indicó image_url ni rutas_bucket para validar"
+                return resumen
+            
+            validacion = validar_factura_tool(rutas, progreso=escalar_progreso(progreso, 1, 2, 3),
+                                              usar_checkpoints=usar_checkpoints)
+            if validacion.get("status") != "success":
+                resumen["error"] = validacion.get("error")
+                return resumen
+            
+            datos_factura = validacion["datos"]
+            resumen["etapas"].append("validacion")
+            resumen["factura"] = {
+                "numero_factura": datos_factura.get("numero_factura"),
+                "empresa_emisora": datos_factura.get("empresa_emisora"),
+                "nit_factura": datos_factura.get("nit_factura"),
+                "fecha_emision": datos_factura.get("fecha_emision"),
+                "monto_total": datos_factura.get("monto_total"),
+                "factura_valida": datos_factura.get("factura_valida"),
+                "vigente": datos_factura.get("vigente"),
+            }
+            
+            if not datos_factura.get("factura_valida"):
+                resumen["status"] = "invalida"
+                resumen["mensaje"] = validacion.get("mensaje")
+                return resumen
+        
+        # ETAPA 3: ENVÍO A SAP
+        if enviar_sap:
+            if not datos_factura:
+                resumen["error"] = "No hay datos de factura para enviar a SAP"
+                return resumen
+            
+            resultado_sap = enviar_factura_a_sap_tool(datos_factura, correo_remitente,
+                                                      progreso=escalar_progreso(progreso, 2, 3, 3))
+            resumen["etapas"].append("sap")
+            resumen["sap"] = {
+                "status": resultado_sap.get("status"),
+                "message": resultado_sap.get("message"),
+                "error": resultado_sap.get("error"),
+            }
+            if resultado_sap.get("status") == "success":
+                data = resultado_sap.get("data") or {}
+                resumen["sap"]["factura_id"] = data.get("factura_id")
+                resumen["sap"]["proveedor_codigo"] = data.get("proveedor_codigo")
+            else:
+                resumen["error"] = resultado_sap.get("error") or resultado_sap.get("message")
+                return resumen
+        
+        resumen["status"] = "success"
+        notificar_progreso(progreso, "completado", 3, 3)
+        return resumen
+        
+    except Exception as e:
+        error_msg = f"Error en procesar_factura_end_to_end_tool: {str(e)}"
+        logger.error(error_msg)
+        resumen["error"] = str(e)
+        return resumen
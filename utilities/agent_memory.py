@@ -0,0 +1,238 @@
+# utilities/agent_memory.py - Memoria acotada del agente y caché de tools MCP
+
+import os
+import json
+import time
+import asyncio
+import tempfile
+import logging
+import threading
+from collections import OrderedDict
+from langgraph.checkpoint.memory import InMemorySaver
+from langchain_core.messages import RemoveMessage
+from langchain_core.messages.utils import trim_messages, count_tokens_approximately
+from langgraph.graph.message import REMOVE_ALL_MESSAGES
+from langchain_mcp_adapters.tools import convert_mcp_tool_to_langchain_tool
+from mcp.types import Tool as MCPTool
+
+logger = logging.getLogger(__name__)
+
+# Hilos (conversaciones de correo) que se mantienen en memoria
+AGENT_MAX_THREADS = int(os.getenv("AGENT_MAX_THREADS", 500))
+# Segundos sin actividad tras los cuales se descarta un hilo
+AGENT_THREAD_TTL = int(os.getenv("AGENT_THREAD_TTL", 6 * 3600))
+# Checkpoints que se conservan por hilo (el último basta para continuar la conversación)
+AGENT_MAX_CHECKPOINTS = int(os.getenv("AGENT_MAX_CHECKPOINTS", 5))
+# Tokens de historial que se envían al modelo en cada turno
+AGENT_MAX_HISTORY_TOKENS = int(os.getenv("AGENT_MAX_HISTORY_TOKENS", 4000))
+# Si es true, el historial recortado reemplaza al guardado (compactación permanente y destructiva)
+AGENT_COMPACT_HISTORY = os.getenv("AGENT_COMPACT_HISTORY", "false").lower() in ("1", "true", "yes")
+# Segundos entre refrescos de las tools MCP en segundo plano
+MCP_TOOLS_REFRESH_SECONDS = int(os.getenv("MCP_TOOLS_REFRESH_SECONDS", 600))
+# Esquemas de las tools MCP guardados en disco para arrancar sin consultar al servidor
+MCP_TOOLS_CACHE_PATH = os.getenv("MCP_TOOLS_CACHE_PATH", os.path.join(tempfile.gettempdir(), "mcp_tools.json"))
+
+
+class BoundedMemorySaver(InMemorySaver):
+    """
+    InMemorySaver con expulsión LRU/TTL por hilo y poda de checkpoints antiguos,
+    para que la memoria del agente no crezca sin límite en instancias de larga vida.
+    """
+
+    def __init__(self, max_threads=AGENT_MAX_THREADS, ttl=AGENT_THREAD_TTL,
+                 max_checkpoints=AGENT_MAX_CHECKPOINTS, **kwargs):
+        super().__init__(**kwargs)
+        self.max_threads = max_threads
+        self.ttl = ttl
+        self.max_checkpoints = max_checkpoints
+        self._ultimo_uso = OrderedDict()
+        self._lru_lock = threading.Lock()
+
+    def _tocar(self, config):
+        thread_id = config["configurable"].get("thread_id")
+        if thread_id is None:
+            return
+        with self._lru_lock:
+            self._ultimo_uso[thread_id] = time.monotonic()
+            self._ultimo_uso.move_to_end(thread_id)
+
+    def _expulsar(self):
+        ahora = time.monotonic()
+        expulsados = []
+        with self._lru_lock:
+            while self._ultimo_uso:
+                thread_id, ultimo = next(iter(self._ultimo_uso.items()))
+                if len(self._ultimo_uso) <= self.max_threads and ahora - ultimo < self.ttl:
+                    break
+                self._ultimo_uso.popitem(last=False)
+                expulsados.append(thread_id)
+        for thread_id in expulsados:
+            self.delete_thread(thread_id)
+        if expulsados:
+            logger.info(f"{len(expulsados)} hilos del agente expulsados de memoria")
+
+    def _podar_checkpoints(self, config):
+        thread_id = config["configurable"].get("thread_id")
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoints = self.storage.get(thread_id, {}).get(checkpoint_ns)
+        if not checkpoints or len(checkpoints) <= self.max_checkpoints:
+            return
+        # Los IDs de checkpoint son ordenables cronológicamente
+        for checkpoint_id in sorted(checkpoints)[:-self.max_checkpoints]:
+            checkpoints.pop(checkpoint_id, None)
+            self.writes.pop((thread_id, checkpoint_ns, checkpoint_id), None)
+
+        # Cada paso guarda una versión nueva de los canales (los mensajes) en blobs;
+        # se borran las versiones que ya no referencia ningún checkpoint conservado
+        vigentes = set()
+        for checkpoint, _, _ in checkpoints.values():
+            vigentes.update(self.serde.loads_typed(checkpoint)["channel_versions"].items())
+        for clave in list(self.blobs):
+            if clave[0] == thread_id and clave[1] == checkpoint_ns and (clave[2], clave[3]) not in vigentes:
+                self.blobs.pop(clave, None)
+
+    def get_tuple(self, config):
+        self._tocar(config)
+        return super().get_tuple(config)
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        self._tocar(config)
+        resultado = super().put(config, checkpoint, metadata, new_versions)
+        self._podar_checkpoints(config)
+        self._expulsar()
+        return resultado
+
+
+def recortar_historial(state):
+    """
+    pre_model_hook del agente: envía al modelo solo los mensajes más recientes
+    que caben en AGENT_MAX_HISTORY_TOKENS. Con AGENT_COMPACT_HISTORY el recorte
+    también reemplaza el historial guardado del hilo.
+    """
+    mensajes = state["messages"]
+    recortados = trim_messages(
+        mensajes,
+        strategy="last",
+        token_counter=count_tokens_approximately,
+        max_tokens=AGENT_MAX_HISTORY_TOKENS,
+        start_on="human",
+        end_on=("human", "tool"),
+        include_system=True,
+    )
+    if not any(m.type == "human" for m in recortados):
+        # Un solo mensaje (p. ej. un correo largo) no cabe en el límite: se envía
+        # desde el último mensaje humano sin recortar y nunca se compacta
+        ultimo = max((i for i, m in enumerate(mensajes) if m.type == "human"), default=0)
+        sistema = [m for m in mensajes[:ultimo] if m.type == "system"]
+        return {"llm_input_messages": sistema + mensajes[ultimo:]}
+    if AGENT_COMPACT_HISTORY and len(recortados) < len(mensajes):
+        return {"messages": [RemoveMessage(id=REMOVE_ALL_MESSAGES), *recortados]}
+    return {"llm_input_messages": recortados}
+
+
+class CachedMCPTools:
+    """
+    Tools del servidor MCP con los esquemas guardados en disco: el agente arranca
+    con ellos sin llamar a la red y un hilo propio los refresca en segundo plano.
+    on_change(tools) se llama solo cuando cambian los nombres o esquemas.
+    """
+
+    def __init__(self, mcp_client, refresh_seconds=MCP_TOOLS_REFRESH_SECONDS, on_change=None,
+                 cache_path=MCP_TOOLS_CACHE_PATH):
+        self.mcp_client = mcp_client
+        self.refresh_seconds = refresh_seconds
+        self.on_change = on_change
+        self.cache_path = cache_path
+        self.tools = []
+        self._firma = None
+        self._hilo = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _esquema(tool):
+        return tool.args_schema if isinstance(tool.args_schema, dict) else tool.args_schema.model_json_schema()
+
+    @classmethod
+    def _firma_de(cls, tools):
+        return tuple(sorted((t.name, json.dumps(cls._esquema(t), sort_keys=True, default=str)) for t in tools))
+
+    def _construir(self, esquemas):
+        """Convierte los esquemas guardados en tools que abren una sesión MCP en cada llamada."""
+        tools = []
+        for esquema in esquemas:
+            conexion = self.mcp_client.connections.get(esquema["server"])
+            if conexion is None:
+                continue
+            mcp_tool = MCPTool(name=esquema["name"], description=esquema.get("description") or "",
+                               inputSchema=esquema["inputSchema"])
+            tools.append(convert_mcp_tool_to_langchain_tool(None, mcp_tool, connection=conexion,
+                                                            server_name=esquema["server"]))
+        return tools
+
+    def load_from_disk(self):
+        """Carga los esquemas guardados por el último refresco; [] si no hay ninguno válido."""
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                tools = self._construir(json.load(f))
+        except FileNotFoundError:
+            return []
+        except Exception as e:
+            logger.warning(f"No se pudieron leer los esquemas MCP guardados en {self.cache_path}: {e}")
+            return []
+
+        with self._lock:
+            self.tools, self._firma = tools, self._firma_de(tools)
+        logger.info(f"{len(tools)} herramientas MCP cargadas desde {self.cache_path}")
+        return tools
+
+    def _guardar(self, esquemas):
+        directorio = os.path.dirname(self.cache_path) or "."
+        try:
+            os.makedirs(directorio, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directorio, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(esquemas, f, ensure_ascii=False, default=str)
+            os.replace(tmp_path, self.cache_path)
+        except Exception as e:
+            logger.warning(f"No se pudieron guardar los esquemas MCP en {self.cache_path}: {e}")
+
+    async def refresh(self):
+        esquemas = []
+        for server in self.mcp_client.connections:
+            for tool in await self.mcp_client.get_tools(server_name=server):
+                esquemas.append({"server": server, "name": tool.name,
+                                 "description": tool.description, "inputSchema": self._esquema(tool)})
+        tools = self._construir(esquemas)
+        firma = self._firma_de(tools)
+
+        with self._lock:
+            cambio = firma != self._firma
+            anterior = self._firma
+            if cambio:
+                self.tools, self._firma = tools, firma
+        if cambio:
+            self._guardar(esquemas)
+            logger.info(f"{len(tools)} herramientas MCP cargadas: {', '.join(t.name for t in tools)}")
+            if anterior is not None and self.on_change:
+                self.on_change(tools)
+        return self.tools
+
+    async def _refrescar_periodicamente(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                # Se mantienen las tools anteriores si el servidor MCP no responde
+                logger.warning(f"No se pudieron refrescar las tools MCP: {e}")
+            await asyncio.sleep(self.refresh_seconds)
+
+    def start_background_refresh(self):
+        """
+        Refresca en un hilo daemon con su propio event loop, para que el refresco
+        sobreviva al loop que ejecutó init_agent (p. ej. asyncio.run en Flask).
+        """
+        if self._hilo is None:
+            self._hilo = threading.Thread(target=asyncio.run, args=(self._refrescar_periodicamente(),),
+                                          name="mcp-tools-refresh", daemon=True)
+            self._hilo.start()
+        return self._hilo
@@ -0,0 +1,153 @@
+# utilities/checkpoints.py - Checkpoints por etapa para reanudar el procesamiento de facturas
+
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_DIR = os.getenv("CHECKPOINT_DIR", os.path.join(tempfile.gettempdir(), "factura_checkpoints"))
+# Segundos que un checkpoint sigue siendo válido
+CHECKPOINT_TTL = int(os.getenv("CHECKPOINT_TTL", 24 * 3600))
+# Segundos entre barridos de checkpoints vencidos (en Cloud Run /tmp ocupa memoria)
+CHECKPOINT_SWEEP_SECONDS = int(os.getenv("CHECKPOINT_SWEEP_SECONDS", 600))
+
+
+def checkpoint_key(*parts):
+    """Clave estable de documento a partir de sus identificadores (ruta GCS, texto, datos...)."""
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class CheckpointStore:
+    """
+    Guarda la salida de cada etapa (transcripción, datos extraídos, proveedor,
+    órdenes de compra, payload, respuesta de SAP) en un JSON por documento, para
+    que un reintento continúe desde la primera etapa incompleta.
+    """
+
+    def __init__(self, directory=CHECKPOINT_DIR, ttl=CHECKPOINT_TTL, sweep_seconds=CHECKPOINT_SWEEP_SECONDS):
+        self.directory = directory
+        self.ttl = ttl
+        self.sweep_seconds = sweep_seconds
+        self._lock = threading.Lock()
+        self._ultimo_barrido = 0.0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def load(self, key):
+        """Etapas vigentes guardadas para el documento ({etapa: valor})."""
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning(f"Checkpoint ilegible para {key}: {e}")
+            return {}
+
+        ahora = time.time()
+        return {etapa: entrada["valor"] for etapa, entrada in data.items()
+                if ahora - entrada.get("ts", 0) < self.ttl}
+
+    def get(self, key, etapa, default=None):
+        return self.load(key).get(etapa, default)
+
+    def save(self, key, etapa, valor):
+        """Guarda la salida de una etapa (escritura atómica del archivo del documento)."""
+        with self._lock:
+            try:
+                with open(self._path(key), "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except (FileNotFoundError, ValueError):
+                data = {}
+
+            data[etapa] = {"ts": time.time(), "valor": valor}
+            self._escribir(key, data)
+
+        self._barrer_si_toca()
+
+    def _escribir(self, key, data):
+        """Escritura atómica del archivo del documento (se llama con el lock tomado)."""
+        if not data:
+            if os.path.exists(self._path(key)):
+                os.remove(self._path(key))
+            return
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, default=str)
+            os.replace(tmp_path, self._path(key))
+        except Exception as e:
+            logger.warning(f"No se pudo guardar el checkpoint de {key}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def discard(self, key, *etapas):
+        """Descarta etapas concretas del documento para que el próximo intento las recalcule."""
+        with self._lock:
+            try:
+                with open(self._path(key), "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except (FileNotFoundError, ValueError):
+                return
+            for etapa in etapas:
+                data.pop(etapa, None)
+            self._escribir(key, data)
+
+    def clear(self, key):
+        with self._lock:
+            if os.path.exists(self._path(key)):
+                os.remove(self._path(key))
+
+    def sweep(self):
+        """Borra los archivos de checkpoint (y temporales huérfanos) más antiguos que el TTL."""
+        limite = time.time() - self.ttl
+        borrados = 0
+        with self._lock:
+            try:
+                nombres = os.listdir(self.directory)
+            except OSError:
+                return 0
+            for nombre in nombres:
+                if not nombre.endswith((".json", ".tmp")):
+                    continue
+                ruta = os.path.join(self.directory, nombre)
+                try:
+                    # Cada save reescribe el archivo, así que mtime es la etapa más reciente
+                    if os.path.getmtime(ruta) < limite:
+                        os.remove(ruta)
+                        borrados += 1
+                except OSError:
+                    continue
+        if borrados:
+            logger.info(f"{borrados} checkpoints vencidos eliminados")
+        return borrados
+
+    def _barrer_si_toca(self):
+        ahora = time.monotonic()
+        if ahora - self._ultimo_barrido < self.sweep_seconds:
+            return
+        self._ultimo_barrido = ahora
+        self.sweep()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_checkpoint_store():
+    """Almacén de checkpoints compartido por el proceso."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = CheckpointStore()
+    return _store
@@ -1,59 +1,121 @@
-import re, os, io
+import re, os, json, time, logging, threading
 from openai import OpenAI
-from llama_parse import LlamaParse
-from pdf2image import convert_from_path
-from google.cloud import vision_v1
-from PIL import Image
+from utilities.ocr import get_backend, get_ocr_router, OCR_INCREMENTAL, OCR_MAX_PAGES
+from utilities.invoice_fields import has_required_invoice_fields
 
 
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "datec-d4g-adn-a.json"
 
 openai_client = OpenAI(api_key=os.getenv("API_OPENAI_KEY"))
 
+logger = logging.getLogger(__name__)
 
-parser = LlamaParse(api_key= "llx-pca1DxoBCQgCHz2zbfiQIS5ng5P6liwDRIwyb807m4hzODyi",
-                    result_type="text",
-                    premium_mode=True)
+# Modelos en orden de escalamiento: se prueba el primero y se escala al siguiente
+# solo si la respuesta no es JSON válido o le faltan campos requeridos
+OPENAI_MODEL_CASCADE = [m.strip() for m in os.getenv("OPENAI_MODEL_CASCADE", "gpt-4o-mini,gpt-4o").split(",") if m.strip()]
 
-def get_transcript_document(path_doc):
-    parser_ci = LlamaParse(api_key= "llx-pca1DxoBCQgCHz2zbfiQIS5ng5P6liwDRIwyb807m4hzODyi", result_type="markdown", premium_mode=True)
-    documents = parser_ci.load_data(path_doc)
-    text = ""
-    for doc in documents:
-        text += f"\n {doc.text} \n"
-    return text
-
-def get_transcript_document_cloud_vision(path_doc):
-    client = vision_v1.ImageAnnotatorClient()
-
-    pages = convert_from_path(path_doc)
-    full_text = ""
-
-    for page_image in pages:
-        buffered = io.BytesIO()
-        page_image.save(buffered, format="JPEG")
-        content = buffered.getvalue()
+# Valores que el modelo usa para indicar que no encontró un campo
+LOW_CONFIDENCE_VALUES = ("", "0", "n/d", "no detectado", "no detectada", "null", "none")
 
-        image = vision_v1.Image(content=content)
-        response = client.document_text_detection(image=image)
+_llm_usage = {}
+_llm_usage_lock = threading.Lock()
 
-        if response.error.message:
-            raise Exception(f"Error: {response.error.message}")
-
-        full_text += response.full_text_annotation.text + "\n"
-
-    return full_text.strip()
 
+def get_transcript_document(path_doc):
+    return get_backend("llamaparse").transcribe(path_doc)
 
-def get_openai_answer(system_prompt, user_prompt):
+def get_transcript_document_cloud_vision(path_doc):
+    return get_backend("cloud_vision").transcribe(path_doc)
+
+def get_transcript_document_routed(path_doc, incremental=OCR_INCREMENTAL, max_pages=OCR_MAX_PAGES, on_page=None):
+    """
+    Transcribe con el backend de OCR que elija el enrutador, con failover.
+    En modo incremental el OCR se detiene en la primera página en la que ya
+    aparecen todos los campos requeridos de la factura (o al llegar a max_pages).
+    on_page(pagina, total_paginas, texto) recibe el texto de cada página al quedar lista.
+    """
+    if incremental:
+        return get_ocr_router().transcribe(path_doc, stop_when=has_required_invoice_fields,
+                                           max_pages=max_pages, on_page=on_page)
+    return get_ocr_router().transcribe(path_doc, on_page=on_page)
+
+
+def record_llm_usage(call_site, model, usage, latency, escalated=False):
+    """Acumula tokens, latencia y número de llamadas por punto de llamada y modelo."""
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+
+    with _llm_usage_lock:
+        stats = _llm_usage.setdefault(call_site, {}).setdefault(model, {
+            "calls": 0,
+            "escalations": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "latency_total": 0.0,
+            "latency_max": 0.0,
+        })
+        stats["calls"] += 1
+        stats["escalations"] += int(escalated)
+        stats["prompt_tokens"] += prompt_tokens
+        stats["completion_tokens"] += completion_tokens
+        stats["latency_total"] += latency
+        stats["latency_max"] = max(stats["latency_max"], latency)
+
+    logger.info(f"OpenAI [{call_site}] {model}: {prompt_tokens}+{completion_tokens} tokens en {latency:.2f}s")
+
+def get_llm_usage_stats():
+    """Copia de las estadísticas acumuladas, con la latencia media calculada."""
+    with _llm_usage_lock:
+        resumen = {}
+        for call_site, modelos in _llm_usage.items():
+            resumen[call_site] = {}
+            for model, stats in modelos.items():
+                resumen[call_site][model] = dict(stats, latency_avg=stats["latency_total"] / stats["calls"])
+        return resumen
+
+def get_openai_answer(system_prompt, user_prompt, model=None, call_site="default", escalated=False):
+    model = model or OPENAI_MODEL_CASCADE[0]
+    inicio = time.monotonic()
     respuesta = openai_client.chat.completions.create(
-        model="gpt-4o-mini",
+        model=model,
         messages=[
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt}
         ],
     )
+    record_llm_usage(call_site, model, respuesta.usage, time.monotonic() - inicio, escalated)
     return respuesta.choices[0].message.content.strip()
 
+def get_openai_json_answer(system_prompt, user_prompt, call_site="default", required_fields=(), validator=None):
+    """
+    Pide una respuesta JSON recorriendo OPENAI_MODEL_CASCADE: empieza por el modelo
+    más barato y escala al siguiente si la respuesta no es JSON, si validator(datos)
+    es False o si algún campo de required_fields viene vacío o como "No detectado".
+    Devuelve la última respuesta válida aunque le falten campos.
+    """
+    mejor = None
+    for nivel, model in enumerate(OPENAI_MODEL_CASCADE):
+        raw = get_openai_answer(system_prompt, user_prompt, model=model, call_site=call_site, escalated=nivel > 0)
+        try:
+            datos = json.loads(get_clean_json(raw))
+        except (AttributeError, ValueError) as e:
+            logger.warning(f"OpenAI [{call_site}] {model} devolvió un JSON inválido: {e}")
+            continue
+
+        if validator and not validator(datos):
+            logger.warning(f"OpenAI [{call_site}] {model}: la respuesta no pasó la validación de esquema")
+            continue
+
+        mejor = datos
+        faltantes = [f for f in required_fields
+                     if str(datos.get(f) if datos.get(f) is not None else "").strip().lower() in LOW_CONFIDENCE_VALUES]
+        if not faltantes:
+            return datos
+        logger.warning(f"OpenAI [{call_site}] {model}: campos con baja confianza {faltantes}")
+
+    if mejor is None:
+        raise ValueError(f"Ningún modelo devolvió un JSON válido para '{call_site}'")
+    return mejor
+
 def get_clean_json(text):
     return re.search(r'(\{.*\})', text, re.DOTALL).group(1)
\ No newline at end of file
@@ -5,9 +5,11 @@ import os
 import time
 import base64
 import re
+import logging
 import requests
 import numpy as np
 from datetime import timedelta
+from utilities.profiling import registrar_temporal
 
 # from src.utilities.config import load_config
 # # from src.preprocessing_images import extract_signature, clean_signature, analizar_documento_google, generateScore
@@ -21,11 +23,13 @@ from datetime import timedelta
 BUCKET_NAME = os.getenv("BUCKET_NAME", "mcp-facturas-bucket")
 storage_client = storage.Client()
 bucket = storage_client.bucket(BUCKET_NAME)
+logger = logging.getLogger(__name__)
+
 EASYCONTACT_KEY ="3HEfwgZ9EQoRLJrkmCtUf4rY"
 ENVIRONMENT = "3HEfwgZ9EQoRLJrkmCtUf4rY"
 
 def upload_image_to_gcs(user_id, image_url):
-    print(f'Media URL: {image_url}')
+    logger.info(f'Media URL: {image_url}')
     
     try:
         if ENVIRONMENT == EASYCONTACT_KEY:
@@ -34,11 +38,11 @@ def upload_image_to_gcs(user_id, image_url):
             r = requests.get(image_url, auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN))
         r.raise_for_status()
     except requests.RequestException as e:
-        print(f"Error al descargar la imagen: {e}")
+        logger.error(f"Error al descargar la imagen: {e}")
         return None
 
     content_type = r.headers.get("Content-Type", "")
-    print(f"Content-Type: {content_type}")
+    logger.info(f"Content-Type: {content_type}")
 
     # if content_type not in ["image/jpeg", "image/png", "image/gif", "pdf"]:
     #     print("Formato de imagen no soportado.")
@@ -55,10 +59,10 @@ def upload_image_to_gcs(user_id, image_url):
         blob = bucket.blob(image_name)
         blob.upload_from_string(image_data, content_type=content_type)
 
-        print(f"{content_type.split('/')[0]} subida a gs://{BUCKET_NAME}/{image_name}")
+        logger.info(f"{content_type.split('/')[0]} subida a gs://{BUCKET_NAME}/{image_name}")
         return image_name
     except Exception as e:
-        print(f"Error al subir la imagen a GCS: {e}")
+        logger.error(f"Error al subir la imagen a GCS: {e}")
         return None
     
 
@@ -91,10 +95,10 @@ def upload_file_base64_to_gcs(user_email: str, file_base64: str):
         blob.upload_from_string(file_data, content_type=content_type)
         blob.make_public()  # para obtener URL pública
 
-        print(f"{content_type.split('/')[0]} subida a gs://{BUCKET_NAME}/{file_name}")
+        logger.info(f"{content_type.split('/')[0]} subida a gs://{BUCKET_NAME}/{file_name}")
         return file_name
     except Exception as e:
-        print(f"Error al subir archivo a GCS: {e}")
+        logger.error(f"Error al subir archivo a GCS: {e}")
         return None
 
 def download_pdf_to_tempfile(source_blob_name):
@@ -103,9 +107,10 @@ def download_pdf_to_tempfile(source_blob_name):
 
     # Crear un archivo temporal
     temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
+    registrar_temporal(temp_file.name)
     blob.download_to_filename(temp_file.name)
 
-    print(f"Archivo temporal descargado en: {temp_file.name}")
+    logger.info(f"Archivo temporal descargado en: {temp_file.name}")
     return temp_file.name
 
 def download_pdf_to_tempfile_local(source_path):
@@ -115,8 +120,9 @@ def download_pdf_to_tempfile_local(source_path):
     """
     if os.path.exists(source_path):
         temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
+        registrar_temporal(temp_file.name)
         shutil.copy(source_path, temp_file.name)
-        print(f"✅ Archivo local copiado a temporal: {temp_file.name}")
+        logger.info(f"Archivo local copiado a temporal: {temp_file.name}")
         return temp_file.name
     else:
         raise FileNotFoundError(f"No se encontró el archivo local: {source_path}")
@@ -0,0 +1,37 @@
+# utilities/invoice_fields.py - Detección rápida de campos de factura sobre texto OCR
+
+import re
+
+# Campos que get_invoice_text_parser_prompt necesita para armar el JSON de SAP.
+# Los patrones cubren el formato de facturas fiscales bolivianas (SIN).
+REQUIRED_INVOICE_FIELDS = {
+    "nit": re.compile(r"\bN\.?\s*I\.?\s*T\.?\b[^\n\d]{0,20}\d{5,}", re.IGNORECASE),
+    "numero_factura": re.compile(
+        r"FACTURA\s*(N[°ºo.]*|NRO\.?|N[ÚU]MERO)[^\n\d]{0,10}\d+", re.IGNORECASE
+    ),
+    "codigo_autorizacion": re.compile(
+        r"(C[ÓO]D(IGO|\.)?\s*(DE\s*)?AUTORIZACI[ÓO]N|CUF)[^\n\w]{0,10}[0-9A-F]{6,}",
+        re.IGNORECASE,
+    ),
+    "fecha": re.compile(r"\b\d{1,2}[/-]\d{1,2}[/-]\d{2,4}\b|\b\d{4}-\d{2}-\d{2}\b"),
+    # Solo el total final de la factura: los arrastres por página ("TOTAL PÁGINA",
+    # "SUBTOTAL") aparecen antes del final del detalle y cortarían el OCR a medias
+    "total": re.compile(
+        r"\b(TOTAL\s+A\s+PAGAR|IMPORTE\s+TOTAL|MONTO\s+TOTAL)\b(?!\s*(DE\s+(LA\s+)?)?P[ÁA]G)"
+        r"[^\n\d]{0,30}\d[\d.,]*"
+        r"|\bSON:?\s+[^\n\d]{3,}\d{2}/100",
+        re.IGNORECASE,
+    ),
+}
+
+
+def detect_invoice_fields(text, fields=None):
+    """Devuelve el conjunto de campos requeridos presentes en el texto."""
+    fields = fields or REQUIRED_INVOICE_FIELDS.keys()
+    return {name for name in fields if REQUIRED_INVOICE_FIELDS[name].search(text)}
+
+
+def has_required_invoice_fields(text, fields=None):
+    """True si el texto ya contiene todos los campos requeridos."""
+    fields = set(fields or REQUIRED_INVOICE_FIELDS.keys())
+    return detect_invoice_fields(text, fields) == fields
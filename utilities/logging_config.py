@@ -0,0 +1,137 @@
+# utilities/logging_config.py - Logging estructurado (JSON) asíncrono con IDs de correlación
+
+import os
+import sys
+import json
+import uuid
+import queue
+import atexit
+import random
+import hashlib
+import logging
+import contextvars
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# Fracción de payloads verbosos (texto OCR, resultados completos) que se registran
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", 0.05))
+# Largo máximo de un campo de texto antes de truncarlo
+LOG_MAX_FIELD_CHARS = int(os.getenv("LOG_MAX_FIELD_CHARS", 200))
+
+correlation_id = contextvars.ContextVar("correlation_id", default=None)
+
+# Atributos estándar de LogRecord que no se copian como campos extra
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+
+@contextmanager
+def correlacion(valor=None):
+    """Asigna un ID de correlación a todo lo que se registre dentro del bloque."""
+    token = correlation_id.set(valor or uuid.uuid4().hex[:12])
+    try:
+        yield correlation_id.get()
+    finally:
+        correlation_id.reset(token)
+
+
+class CorrelationFilter(logging.Filter):
+    """Agrega el ID de correlación al registro en el hilo que lo emite."""
+
+    def filter(self, record):
+        record.correlation_id = correlation_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Una línea JSON por registro, con los campos que Cloud Logging reconoce."""
+
+    def format(self, record):
+        entrada = {
+            "severity": record.levelname,
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "correlation_id", None):
+            entrada["correlation_id"] = record.correlation_id
+        for clave, valor in record.__dict__.items():
+            if clave not in _RECORD_ATTRS and clave != "correlation_id":
+                entrada[clave] = valor
+        if record.exc_info:
+            entrada["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entrada, ensure_ascii=False, default=str)
+
+
+class RawQueueHandler(QueueHandler):
+    """
+    QueueHandler que encola el registro sin formatearlo. El prepare estándar
+    formatea en el hilo que llama y borra exc_info, con lo que el traceback
+    terminaría dentro de "message"; aquí solo se resuelve el mensaje (los args
+    podrían cambiar antes de que el listener lo procese) y JsonFormatter arma
+    "exception" en el hilo del listener.
+    """
+
+    def prepare(self, record):
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def resumir_payload(valor, max_chars=LOG_MAX_FIELD_CHARS):
+    """Trunca los textos largos (con hash y largo original) dentro de dicts y listas."""
+    if isinstance(valor, str):
+        if len(valor) <= max_chars:
+            return valor
+        digest = hashlib.sha256(valor.encode("utf-8")).hexdigest()[:16]
+        return f"{valor[:max_chars]}… [len={len(valor)} sha256={digest}]"
+    if isinstance(valor, dict):
+        return {k: resumir_payload(v, max_chars) for k, v in valor.items()}
+    if isinstance(valor, (list, tuple)):
+        return [resumir_payload(v, max_chars) for v in valor]
+    return valor
+
+
+def log_payload(logger, mensaje, payload, level=logging.INFO):
+    """
+    Registra un payload verboso solo para una muestra de las llamadas
+    (LOG_PAYLOAD_SAMPLE_RATE); en el resto se registra el mensaje sin el payload.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if random.random() < LOG_PAYLOAD_SAMPLE_RATE:
+        logger.log(level, mensaje, extra={"payload": resumir_payload(payload)})
+    else:
+        logger.log(level, mensaje)
+
+
+_listener = None
+
+
+def configure_logging(level=LOG_LEVEL):
+    """
+    Reemplaza los handlers del logger raíz por un RawQueueHandler: el hilo de la
+    petición solo encola el registro y un QueueListener en segundo plano lo
+    formatea como JSON y lo escribe en stdout.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    cola = queue.SimpleQueue()
+    salida = logging.StreamHandler(sys.stdout)
+    salida.setFormatter(JsonFormatter())
+
+    handler = RawQueueHandler(cola)
+    handler.addFilter(CorrelationFilter())
+
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    _listener = QueueListener(cola, salida, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
@@ -0,0 +1,347 @@
+# utilities/ocr.py - Backends de OCR intercambiables y enrutador por latencia
+
+import os
+import time
+import logging
+import threading
+from pdf2image import pdfinfo_from_path
+from google.cloud import vision_v1
+from llama_parse import LlamaParse
+from utilities.workers import submit_cpu_bound, render_pdf_pages, get_process_pool, OCR_RENDER_WINDOW
+
+logger = logging.getLogger(__name__)
+
+LLAMA_PARSE_API_KEY = os.getenv("LLAMA_CLOUD_API_KEY", "llx-pca1DxoBCQgCHz2zbfiQIS5ng5P6liwDRIwyb807m4hzODyi")
+
+# Orden de preferencia por defecto de los backends (separados por coma)
+OCR_BACKENDS = os.getenv("OCR_BACKENDS", "cloud_vision,llamaparse")
+
+# Modo incremental (opcional): OCR página a página con corte temprano al tener los campos requeridos
+OCR_INCREMENTAL = os.getenv("OCR_INCREMENTAL", "false").lower() in ("1", "true", "yes")
+OCR_MAX_PAGES = int(os.getenv("OCR_MAX_PAGES", 5))
+
+# Segundos que un backend queda penalizado tras un error antes de volver a preferirse
+OCR_FAILURE_COOLDOWN = float(os.getenv("OCR_FAILURE_COOLDOWN", 60))
+
+# Límites de tamaño por backend: por encima no se elige salvo que no quede otro
+OCR_CLOUD_VISION_MAX_PAGES = int(os.getenv("OCR_CLOUD_VISION_MAX_PAGES", 30))
+OCR_LLAMAPARSE_MAX_MB = float(os.getenv("OCR_LLAMAPARSE_MAX_MB", 50))
+
+
+class OCRBackendError(Exception):
+    """Error producido por un backend de OCR."""
+
+
+class OCRBackend:
+    """
+    Interfaz común de los backends de OCR.
+
+    Cada backend reutiliza su cliente entre llamadas. La transcripción es
+    bloqueante: se ejecuta en el hilo de la petición (asyncio.to_thread en el servidor).
+    """
+    name = "base"
+    # Latencia inicial estimada (segundos fijos + segundos por página + segundos por MB)
+    overhead_seconds = 0.0
+    seconds_per_page = 1.0
+    seconds_per_mb = 0.0
+    # Límites opcionales que el enrutador respeta
+    max_pages = None
+    max_bytes = None
+    # True si el backend trabaja página a página y puede detenerse antes del final
+    paged = False
+
+    def supports(self, page_count, size_bytes):
+        if self.max_pages is not None and page_count > self.max_pages:
+            return False
+        if self.max_bytes is not None and size_bytes > self.max_bytes:
+            return False
+        return True
+
+    def transcribe_pages(self, path_doc, stop_when=None, max_pages=None, on_page=None):
+        """
+        Transcribe el documento y devuelve (texto, páginas procesadas). Si se
+        indica stop_when, los backends por página se detienen cuando
+        stop_when(texto) sea True; los demás procesan el documento completo.
+        Si se indica on_page, se llama con (número de página, total de páginas,
+        texto de la página) a medida que cada página queda lista.
+        """
+        raise NotImplementedError
+
+    def transcribe(self, path_doc, on_page=None):
+        return self.transcribe_pages(path_doc, on_page=on_page)[0]
+
+
+class CloudVisionBackend(OCRBackend):
+    """OCR página a página con Google Cloud Vision sobre el PDF rasterizado."""
+    name = "cloud_vision"
+    paged = True
+    overhead_seconds = 0.5
+    seconds_per_page = 1.5
+    # Los PDF escaneados pesados tardan más en rasterizarse en el contenedor
+    seconds_per_mb = 0.2
+    # El OCR es secuencial por página; los documentos largos van a LlamaParse
+    max_pages = OCR_CLOUD_VISION_MAX_PAGES
+
+    def __init__(self):
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = vision_v1.ImageAnnotatorClient()
+        return self._client
+
+    def transcribe_image(self, content):
+        """Transcribe una página ya codificada (bytes JPEG/PNG)."""
+        image = vision_v1.Image(content=content)
+        response = self.client.document_text_detection(image=image)
+
+        if response.error.message:
+            raise OCRBackendError(f"Error: {response.error.message}")
+
+        return response.full_text_annotation.text
+
+    def transcribe_pages(self, path_doc, stop_when=None, max_pages=None, on_page=None):
+        if stop_when is None:
+            return self._transcribe_all(path_doc, on_page)
+        return self._transcribe_until(path_doc, stop_when, max_pages, on_page)
+
+    def _transcribe_all(self, path_doc, on_page):
+        page_count = get_page_count(path_doc)
+        full_text = ""
+
+        # Las páginas se rasterizan en el pool de procesos con a lo sumo
+        # OCR_RENDER_WINDOW en curso; el OCR avanza en orden a medida que cada
+        # página está lista
+        pendientes = {}
+        siguiente = 1
+        try:
+            for page_number in range(1, page_count + 1):
+                while siguiente <= page_count and len(pendientes) < max(OCR_RENDER_WINDOW, 1):
+                    pendientes[siguiente] = submit_cpu_bound(render_pdf_pages, path_doc, siguiente, siguiente)
+                    siguiente += 1
+
+                for content in pendientes.pop(page_number).result():
+                    page_text = self.transcribe_image(content)
+                    full_text += page_text + "\n"
+                    if on_page:
+                        on_page(page_number, page_count, page_text)
+        finally:
+            # Si el OCR falla no se siguen rasterizando páginas que nadie va a leer
+            for future in pendientes.values():
+                future.cancel()
+
+        return full_text.strip(), page_count
+
+    def _transcribe_until(self, path_doc, stop_when, max_pages, on_page):
+        page_count = get_page_count(path_doc)
+        if max_pages:
+            page_count = min(page_count, max_pages)
+        full_text = ""
+        procesadas = 0
+
+        # Se rasteriza una página a la vez (con la siguiente ya en curso en el pool)
+        # para no pagar las páginas que no se usan
+        prefetch = get_process_pool() is not None
+        pendiente = submit_cpu_bound(render_pdf_pages, path_doc, 1, 1)
+        for page_number in range(1, page_count + 1):
+            if pendiente is None:
+                pendiente = submit_cpu_bound(render_pdf_pages, path_doc, page_number, page_number)
+            encoded = pendiente.result()
+            pendiente = None
+            if prefetch and page_number < page_count:
+                pendiente = submit_cpu_bound(render_pdf_pages, path_doc, page_number + 1, page_number + 1)
+            if not encoded:
+                break
+            page_text = self.transcribe_image(encoded[0])
+            full_text += page_text + "\n"
+            procesadas = page_number
+            if on_page:
+                on_page(page_number, page_count, page_text)
+
+            if stop_when(full_text):
+                logger.info(f"Campos requeridos encontrados en la página {page_number}, se detiene el OCR")
+                if pendiente is not None:
+                    pendiente.cancel()
+                break
+
+        return full_text.strip(), procesadas
+
+
+class LlamaParseBackend(OCRBackend):
+    """OCR con LlamaParse, con un único cliente compartido (num_workers en paralelo)."""
+    name = "llamaparse"
+    overhead_seconds = 8.0
+    seconds_per_page = 0.5
+    # El PDF completo se sube al servicio
+    seconds_per_mb = 0.5
+    max_bytes = int(OCR_LLAMAPARSE_MAX_MB * 1024 ** 2)
+
+    def __init__(self, result_type="markdown", num_workers=4):
+        self.result_type = result_type
+        self.num_workers = num_workers
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = LlamaParse(api_key=LLAMA_PARSE_API_KEY,
+                                              result_type=self.result_type,
+                                              premium_mode=True,
+                                              num_workers=self.num_workers)
+        return self._client
+
+    @staticmethod
+    def _join(documents):
+        text = ""
+        for doc in documents:
+            text += f"\n {doc.text} \n"
+        return text
+
+    # LlamaParse devuelve un documento por página (split_by_page)
+    def transcribe_pages(self, path_doc, stop_when=None, max_pages=None, on_page=None):
+        documents = self.client.load_data(path_doc)
+        return self._join(documents), len(documents)
+
+
+def get_page_count(path_doc):
+    """Número de páginas del PDF (1 si no se puede determinar)."""
+    try:
+        return int(pdfinfo_from_path(path_doc).get("Pages", 1))
+    except Exception as e:
+        logger.warning(f"No se pudo obtener el número de páginas de {path_doc}: {e}")
+        return 1
+
+
+class OCRRouter:
+    """
+    Elige el backend de OCR para cada documento según número de páginas,
+    tamaño y latencia reciente observada, con failover automático.
+    """
+
+    def __init__(self, backends, alpha=0.3, failure_cooldown=OCR_FAILURE_COOLDOWN):
+        self.backends = {}
+        self.alpha = alpha
+        self.failure_cooldown = failure_cooldown
+        self._lock = threading.Lock()
+        # Media móvil exponencial de segundos por página, por backend
+        self._seconds_per_page = {}
+        self._failed_at = {}
+        for backend in backends:
+            self.register(backend)
+
+    def register(self, backend):
+        with self._lock:
+            self.backends.setdefault(backend.name, backend)
+            self._seconds_per_page.setdefault(backend.name, backend.seconds_per_page)
+        return self.backends[backend.name]
+
+    @staticmethod
+    def fixed_cost(backend, size_bytes):
+        """Parte de la latencia que no depende del número de páginas."""
+        return backend.overhead_seconds + backend.seconds_per_mb * size_bytes / 1024 ** 2
+
+    def estimate(self, backend, page_count, size_bytes=0):
+        with self._lock:
+            per_page = self._seconds_per_page[backend.name]
+        return self.fixed_cost(backend, size_bytes) + per_page * page_count
+
+    @staticmethod
+    def pages_for(backend, page_count, max_pages=None):
+        """Páginas que el backend procesará: solo los backends por página respetan max_pages."""
+        if backend.paged and max_pages:
+            return min(page_count, max_pages)
+        return page_count
+
+    def rank(self, path_doc, max_pages=None):
+        """Backends ordenados del más al menos conveniente para el documento."""
+        page_count = get_page_count(path_doc)
+        size_bytes = os.path.getsize(path_doc)
+        now = time.monotonic()
+
+        candidatos = [b for b in self.backends.values()
+                      if b.supports(self.pages_for(b, page_count, max_pages), size_bytes)]
+        if not candidatos:
+            candidatos = list(self.backends.values())
+
+        def clave(backend):
+            with self._lock:
+                failed_at = self._failed_at.get(backend.name)
+            penalizado = failed_at is not None and now - failed_at < self.failure_cooldown
+            return (penalizado, self.estimate(backend, self.pages_for(backend, page_count, max_pages), size_bytes))
+
+        ordenados = sorted(candidatos, key=clave)
+        return ordenados, page_count, size_bytes
+
+    def record_success(self, name, elapsed, pages_processed, size_bytes=0):
+        """Actualiza la media de segundos por página con las páginas realmente procesadas."""
+        if pages_processed <= 0:
+            return
+        backend = self.backends[name]
+        observed = max(elapsed - self.fixed_cost(backend, size_bytes), 0.0) / pages_processed
+        with self._lock:
+            previo = self._seconds_per_page[name]
+            self._seconds_per_page[name] = self.alpha * observed + (1 - self.alpha) * previo
+            self._failed_at.pop(name, None)
+
+    def record_failure(self, name):
+        with self._lock:
+            self._failed_at[name] = time.monotonic()
+
+    def transcribe(self, path_doc, stop_when=None, max_pages=None, on_page=None):
+        """
+        Transcribe con el mejor backend disponible. Si se indica stop_when, los
+        backends por página cortan en cuanto el texto acumulado lo cumple.
+        """
+        ordenados, page_count, size_bytes = self.rank(path_doc, max_pages)
+        errores = []
+        for backend in ordenados:
+            inicio = time.monotonic()
+            try:
+                logger.info(f"OCR con backend '{backend.name}' ({page_count} páginas)")
+                text, procesadas = backend.transcribe_pages(path_doc, stop_when, max_pages, on_page=on_page)
+            except Exception as e:
+                logger.warning(f"Backend OCR '{backend.name}' falló: {e}")
+                self.record_failure(backend.name)
+                errores.append(f"{backend.name}: {e}")
+                continue
+            self.record_success(backend.name, time.monotonic() - inicio, procesadas, size_bytes)
+            return text
+        raise OCRBackendError(f"Todos los backends de OCR fallaron: {'; '.join(errores)}")
+
+
+_BACKEND_FACTORIES = {
+    CloudVisionBackend.name: CloudVisionBackend,
+    LlamaParseBackend.name: LlamaParseBackend,
+}
+
+_backends = {}
+_router = None
+_registry_lock = threading.Lock()
+
+
+def get_backend(name):
+    """Instancia compartida por el proceso de un backend concreto."""
+    if name not in _backends:
+        with _registry_lock:
+            if name not in _backends:
+                _backends[name] = _BACKEND_FACTORIES[name]()
+    return _backends[name]
+
+
+def get_ocr_router():
+    """Enrutador compartido por el proceso, construido a partir de OCR_BACKENDS."""
+    global _router
+    if _router is None:
+        nombres = [n.strip() for n in OCR_BACKENDS.split(",") if n.strip()]
+        backends = [get_backend(n) for n in nombres]
+        with _registry_lock:
+            if _router is None:
+                _router = OCRRouter(backends)
+    return _router
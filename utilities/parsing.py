@@ -0,0 +1,78 @@
+# utilities/parsing.py - Normalización de montos y fechas leídos de facturas
+
+import re
+import logging
+from datetime import datetime, date
+
+logger = logging.getLogger(__name__)
+
+_FORMATOS_FECHA = ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y", "%Y/%m/%d", "%d.%m.%Y", "%d/%m/%y", "%m/%d/%Y")
+_MESES = {"enero": 1, "febrero": 2, "marzo": 3, "abril": 4, "mayo": 5, "junio": 6, "julio": 7,
+          "agosto": 8, "septiembre": 9, "setiembre": 9, "octubre": 10, "noviembre": 11, "diciembre": 12}
+
+# Primer número del texto: descarta prefijos de moneda como 'Bs.' o 'USD'
+_NUMERO = re.compile(r"-?\d[\d.,]*")
+
+
+def parsear_monto(valor, por_defecto=0.0):
+    """
+    Convierte un monto de factura (número o texto como '1.234,50' o 'Bs. 1,234.50') a float.
+    Devuelve por_defecto si el valor no trae ningún número (vacío, 'No detectado').
+    """
+    if isinstance(valor, (int, float)):
+        return float(valor)
+    coincidencia = _NUMERO.search(str(valor or ""))
+    if not coincidencia:
+        return por_defecto
+
+    texto = coincidencia.group(0).rstrip(".,")
+    if "," in texto and "." in texto:
+        # El último separador es el decimal
+        if texto.rfind(",") > texto.rfind("."):
+            texto = texto.replace(".", "").replace(",", ".")
+        else:
+            texto = texto.replace(",", "")
+    elif "," in texto or "." in texto:
+        # Con un solo tipo de separador: si se repite o le siguen exactamente 3 dígitos
+        # es separador de miles ('12.500', '1.250.000'); si no, es el decimal.
+        # Con parte entera 0 siempre es decimal ('0.500')
+        separador = "," if "," in texto else "."
+        entero, _, decimales = texto.rpartition(separador)
+        es_miles = texto.count(separador) > 1 or len(decimales) == 3
+        if es_miles and entero.lstrip("-") != "0":
+            texto = texto.replace(separador, "")
+        else:
+            texto = f"{entero}.{decimales}"
+
+    try:
+        return float(texto)
+    except ValueError:
+        logger.error(f"Formato de monto inválido: {valor}")
+        return por_defecto
+
+
+def parsear_fecha(valor):
+    """
+    Fecha de una factura como date, sea texto libre del validador ('15/03/2024',
+    '15.03.2024', '15 de marzo de 2024') o formato SAP ('2024-03-15T00:00:00').
+    None si no se reconoce.
+    """
+    if isinstance(valor, datetime):
+        return valor.date()
+    if isinstance(valor, date):
+        return valor
+    texto = str(valor or "").strip().split("T")[0].strip()
+    if not texto:
+        return None
+    for fmt in _FORMATOS_FECHA:
+        try:
+            return datetime.strptime(texto, fmt).date()
+        except ValueError:
+            continue
+    coincidencia = re.search(r"(\d{1,2})\s+de\s+([a-záéíóú]+)\s+(?:de|del)\s+(\d{4})", texto.lower())
+    if coincidencia and coincidencia.group(2) in _MESES:
+        try:
+            return date(int(coincidencia.group(3)), _MESES[coincidencia.group(2)], int(coincidencia.group(1)))
+        except ValueError:
+            return None
+    return None
@@ -0,0 +1,251 @@
+# utilities/po_matching.py - Emparejamiento de facturas con posiciones de órdenes de compra
+
+import os
+import time
+import heapq
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Tolerancia relativa al comparar montos (0.01 = 1%)
+PO_MATCH_TOLERANCE = float(os.getenv("PO_MATCH_TOLERANCE", 0.01))
+# Segundos que se reutiliza el índice de posiciones abiertas de un proveedor
+PO_INDEX_TTL = int(os.getenv("PO_INDEX_TTL", 300))
+# Máximo de posiciones consideradas al buscar combinaciones que sumen el total
+PO_SUBSET_MAX_LINES = 25
+# Máximo de sumas parciales activas en esa búsqueda (acota tiempo y memoria por factura)
+PO_SUBSET_MAX_STATES = int(os.getenv("PO_SUBSET_MAX_STATES", 5000))
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def montos_cercanos(a, b, tolerancia=PO_MATCH_TOLERANCE):
+    return abs(a - b) <= max(abs(b) * tolerancia, 0.01)
+
+
+class PurchaseOrderLine:
+    """
+    Posición abierta de una orden de compra (A_PurchaseOrderItem). La cantidad
+    y el monto son los pendientes de facturar: OrderQuantity menos InvoicedQuantity
+    (lo ya referenciado en facturas de proveedor, si el item lo trae).
+    """
+
+    def __init__(self, item):
+        self.purchase_order = item.get("PurchaseOrder", "")
+        self.purchase_order_item = item.get("PurchaseOrderItem", "00010")
+        self.material = str(item.get("Material", "") or "").strip().upper()
+        self.description = item.get("PurchaseOrderItemText", "")
+        self.ordered_quantity = to_float(item.get("OrderQuantity"))
+        self.invoiced_quantity = to_float(item.get("InvoicedQuantity"))
+        self.quantity = max(self.ordered_quantity - self.invoiced_quantity, 0.0)
+        self.unit = item.get("PurchaseOrderQuantityUnit", "EA") or "EA"
+        self.currency = item.get("DocumentCurrency", "BOB") or "BOB"
+        self.tax_code = item.get("TaxCode", "V0") or "V0"
+        # NetPriceAmount es el precio por NetPriceQuantity unidades
+        price_quantity = to_float(item.get("NetPriceQuantity")) or 1.0
+        self.unit_price = to_float(item.get("NetPriceAmount")) / price_quantity
+        self.amount = self.unit_price * self.quantity
+
+    def referencia(self, amount, quantity=None):
+        """Asignación de monto/cantidad de la factura a esta posición."""
+        if quantity is None:
+            quantity = amount / self.unit_price if self.unit_price else 1.0
+        return {
+            "PurchaseOrder": self.purchase_order,
+            "PurchaseOrderItem": self.purchase_order_item,
+            "Quantity": round(quantity, 3),
+            "PurchaseOrderQuantityUnit": self.unit,
+            "DocumentCurrency": self.currency,
+            "Amount": round(amount, 2),
+            "TaxCode": self.tax_code,
+        }
+
+
+class PurchaseOrderIndex:
+    """
+    Índice de las posiciones abiertas de un proveedor por código de producto
+    y por monto, para elegir las posiciones que mejor cubren una factura.
+    """
+
+    def __init__(self, items):
+        # Las posiciones ya facturadas por completo no pueden recibir más montos
+        self.lines = [l for l in (PurchaseOrderLine(i) for i in items) if l.quantity > 0.0005]
+        self.by_material = {}
+        for line in self.lines:
+            if line.material:
+                self.by_material.setdefault(line.material, []).append(line)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def _match_item(self, item, disponibles):
+        """Mejor posición para un ítem de factura: por código de producto y luego por precio/monto."""
+        codigo = str(item.get("ProductCode", "") or "").strip().upper()
+        cantidad = to_float(item.get("Quantity"))
+        precio = to_float(item.get("UnitPrice"))
+        subtotal = to_float(item.get("Subtotal")) or cantidad * precio
+
+        candidatas = [l for l in self.by_material.get(codigo, []) if l in disponibles] if codigo else []
+        if not candidatas:
+            candidatas = [l for l in disponibles
+                          if (precio and montos_cercanos(l.unit_price, precio))
+                          or (subtotal and montos_cercanos(l.amount, subtotal))]
+        if not candidatas:
+            return None, subtotal, cantidad
+
+        # Preferir la posición con cantidad suficiente y precio más parecido
+        mejor = min(candidatas, key=lambda l: (l.quantity < cantidad, abs(l.unit_price - precio)))
+        return mejor, subtotal, cantidad
+
+    def _match_total(self, monto, disponibles):
+        """Posiciones cuyo monto, solo o combinado, cubre el total de la factura."""
+        # 1) Una sola posición con el mismo monto
+        for line in disponibles:
+            if montos_cercanos(line.amount, monto):
+                return [(line, monto)]
+
+        # 2) Combinación de posiciones cuya suma coincide con el total (suma de subconjuntos en centavos)
+        candidatas = [l for l in sorted(disponibles, key=lambda l: l.amount, reverse=True)[:PO_SUBSET_MAX_LINES]
+                      if round(l.amount * 100) > 0]
+        centavos = [round(l.amount * 100) for l in candidatas]
+        objetivo = round(monto * 100)
+        margen = round(max(monto * PO_MATCH_TOLERANCE, 0.01) * 100)
+        # Si ni todas las posiciones juntas llegan al total no hay combinación posible
+        if sum(centavos) >= objetivo - margen:
+            indices = self._subset_sum(centavos, objetivo, margen)
+            if indices:
+                return [(candidatas[i], candidatas[i].amount) for i in indices]
+
+        # 3) La posición más pequeña que alcanza para cubrir el total completo
+        suficientes = [l for l in disponibles if l.amount >= monto]
+        if suficientes:
+            return [(min(suficientes, key=lambda l: l.amount), monto)]
+
+        return []
+
+    @staticmethod
+    def _subset_sum(valores, objetivo, margen, max_estados=PO_SUBSET_MAX_STATES):
+        """
+        Índices de valores (enteros positivos) cuya suma queda a ±margen de objetivo,
+        la más cercana encontrada, o None. Se recorren las sumas alcanzables guardando
+        solo un puntero (suma anterior, índice) por suma y a lo sumo max_estados sumas
+        activas, las más cercanas al objetivo; con muchas posiciones la búsqueda deja
+        de ser exhaustiva pero su costo queda acotado.
+        """
+        restante = sum(valores)
+        origen = {0: None}
+        frontera = [0]
+        mejor = None
+
+        for i, valor in enumerate(valores):
+            # restante pasa a ser la suma de los valores posteriores a i
+            restante -= valor
+            nuevas = []
+            for suma in frontera:
+                nueva = suma + valor
+                if nueva > objetivo + margen or nueva in origen:
+                    continue
+                origen[nueva] = (suma, i)
+                nuevas.append(nueva)
+                if abs(nueva - objetivo) <= margen and (mejor is None or abs(nueva - objetivo) < abs(mejor - objetivo)):
+                    mejor = nueva
+            if mejor == objetivo:
+                break
+
+            # Se descartan las sumas que ya no pueden llegar al objetivo con lo que queda
+            frontera = [s for s in frontera + nuevas if s + restante >= objetivo - margen]
+            if len(frontera) > max_estados:
+                frontera = heapq.nlargest(max_estados, frontera)
+            if not frontera:
+                break
+
+        if mejor is None:
+            return None
+
+        indices = []
+        suma = mejor
+        while origen[suma] is not None:
+            suma, i = origen[suma]
+            indices.append(i)
+        return indices[::-1]
+
+    def match(self, invoice_items, invoice_amount):
+        """
+        Devuelve las referencias a posiciones de OC para la factura. Primero se
+        empareja cada ítem extraído; si no se logra cubrir el total, se busca
+        por monto. Lista vacía si ninguna combinación cubre la factura.
+        """
+        disponibles = list(self.lines)
+        referencias = []
+        cubierto = 0.0
+
+        for item in invoice_items or []:
+            line, subtotal, cantidad = self._match_item(item, disponibles)
+            if line is None or not subtotal:
+                continue
+            disponibles.remove(line)
+            referencias.append(line.referencia(subtotal, cantidad or None))
+            cubierto += subtotal
+
+        if referencias and montos_cercanos(cubierto, invoice_amount):
+            return self._cuadrar(referencias, invoice_amount)
+
+        if referencias:
+            logger.warning(f"Los ítems emparejados suman {cubierto:.2f} y la factura {invoice_amount:.2f}; "
+                           f"se empareja por monto total")
+
+        referencias = [line.referencia(monto) for line, monto in self._match_total(invoice_amount, list(self.lines))]
+        return self._cuadrar(referencias, invoice_amount)
+
+    @staticmethod
+    def _cuadrar(referencias, monto):
+        """
+        Asigna a la última referencia la diferencia (dentro de la tolerancia) entre
+        la suma de las posiciones y el total, para que el payload cuadre con InvoiceGrossAmount.
+        """
+        if referencias:
+            diferencia = round(monto - sum(r["Amount"] for r in referencias), 2)
+            if diferencia:
+                referencias[-1]["Amount"] = round(referencias[-1]["Amount"] + diferencia, 2)
+        return referencias
+
+
+class PurchaseOrderIndexCache:
+    """Índices de posiciones abiertas por proveedor, con expiración."""
+
+    def __init__(self, ttl=PO_INDEX_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._indices = {}
+
+    def get(self, supplier_code, loader):
+        """
+        Índice del proveedor; loader(supplier_code) devuelve las posiciones si hay
+        que recargar, o None si la consulta falló (en ese caso se devuelve None).
+        """
+        with self._lock:
+            entrada = self._indices.get(supplier_code)
+        if entrada and time.monotonic() - entrada[0] < self.ttl:
+            return entrada[1]
+
+        items = loader(supplier_code)
+        if items is None:
+            # Fallo al consultar SAP: no se guarda, el próximo intento vuelve a cargar
+            return None
+        indice = PurchaseOrderIndex(items)
+        with self._lock:
+            self._indices[supplier_code] = (time.monotonic(), indice)
+        return indice
+
+    def invalidate(self, supplier_code):
+        with self._lock:
+            self._indices.pop(supplier_code, None)
+
+
+po_index_cache = PurchaseOrderIndexCache()
@@ -0,0 +1,209 @@
+# utilities/profiling.py - Perfilado de memoria y CPU por invocación de tool (activado con MCP_PROFILING)
+
+import os
+import json
+import time
+import pstats
+import cProfile
+import logging
+import resource
+import tempfile
+import threading
+import tracemalloc
+from contextvars import ContextVar
+from datetime import datetime
+from functools import wraps
+from utilities.workers import worker_pids
+
+logger = logging.getLogger(__name__)
+
+MCP_PROFILING = os.getenv("MCP_PROFILING", "false").lower() in ("1", "true", "yes")
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "mcp_profiles"))
+# Frames guardados por asignación (más frames = trazas más útiles y más overhead)
+PROFILE_TRACEMALLOC_FRAMES = int(os.getenv("PROFILE_TRACEMALLOC_FRAMES", 10))
+PROFILE_TOP_N = 10
+
+_lock = threading.Lock()
+_en_vuelo = 0
+_registros = []
+# Temporales creados por la invocación en curso (None fuera de una invocación perfilada)
+_temporales = ContextVar("temporales_invocacion", default=None)
+
+
+def rss_actual_mb():
+    """RSS actual del proceso en MB (Linux: /proc/self/statm)."""
+    try:
+        with open("/proc/self/statm") as f:
+            paginas = int(f.read().split()[1])
+        return paginas * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError):
+        return 0.0
+
+
+def rss_maximo_mb():
+    """Pico de RSS del proceso desde su inicio (ru_maxrss está en KB en Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def memoria_workers_mb():
+    """
+    RSS actual y pico (VmHWM) sumados de los workers del pool de procesos, donde se
+    rasterizan las páginas; ni tracemalloc ni el RSS del servidor los incluyen.
+    """
+    actual = pico = 0.0
+    for pid in worker_pids():
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for linea in f:
+                    if linea.startswith("VmRSS:"):
+                        actual += int(linea.split()[1]) / 1024
+                    elif linea.startswith("VmHWM:"):
+                        pico += int(linea.split()[1]) / 1024
+        except (OSError, ValueError):
+            continue
+    return actual, pico
+
+
+def registrar_temporal(ruta):
+    """Anota un archivo temporal creado por la invocación perfilada en curso."""
+    creados = _temporales.get()
+    if creados is not None:
+        creados.append(ruta)
+
+
+def perfilar(nombre, funcion):
+    """
+    Envuelve funcion para registrar, si MCP_PROFILING está activo, la duración,
+    el pico de memoria Python (tracemalloc), el RSS del servidor y de los workers,
+    los puntos con más asignaciones, los temporales que la propia invocación deja
+    sin borrar (registrados con registrar_temporal) y un perfil de CPU
+    (.prof en PROFILE_DIR) de las invocaciones que no se solapan con otras.
+    Debe ejecutarse en el hilo que hace el trabajo.
+    """
+    if not MCP_PROFILING:
+        return funcion
+
+    @wraps(funcion)
+    def wrapper(*args, **kwargs):
+        global _en_vuelo
+        with _lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+                os.makedirs(PROFILE_DIR, exist_ok=True)
+            _en_vuelo += 1
+            concurrentes = _en_vuelo
+            # El pico de tracemalloc es global; solo se reinicia si no hay otras invocaciones
+            if concurrentes == 1:
+                tracemalloc.reset_peak()
+
+        antes = tracemalloc.take_snapshot()
+        token_temporales = _temporales.set([])
+        rss_inicio = rss_actual_mb()
+        inicio = time.perf_counter()
+        perfil = None
+        error = None
+
+        try:
+            # Solo puede haber un profiler activo por proceso (Python >= 3.12): el perfil
+            # de CPU se toma únicamente cuando la invocación no se solapa con otra
+            if concurrentes == 1:
+                perfil = cProfile.Profile()
+                try:
+                    perfil.enable()
+                except ValueError as e:
+                    logger.warning(f"No se pudo activar el perfil de CPU de '{nombre}': {e}")
+                    perfil = None
+            return funcion(*args, **kwargs)
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            if perfil is not None:
+                perfil.disable()
+            duracion = time.perf_counter() - inicio
+            _, pico = tracemalloc.get_traced_memory()
+            despues = tracemalloc.take_snapshot()
+            temporales = _temporales.get()
+            _temporales.reset(token_temporales)
+            rss_workers, rss_workers_maximo = memoria_workers_mb()
+            with _lock:
+                _en_vuelo -= 1
+
+            ts = datetime.now().strftime("%Y%m%dT%H%M%S%f")
+            ruta_prof = None
+            top_cpu = []
+            if perfil is not None:
+                ruta_prof = os.path.join(PROFILE_DIR, f"{nombre}-{ts}.prof")
+                perfil.dump_stats(ruta_prof)
+                stats = pstats.Stats(perfil).sort_stats("cumulative")
+                for (archivo, linea, func), (_, ncalls, _, cumtime, _) in list(stats.stats.items()):
+                    top_cpu.append({"funcion": f"{os.path.basename(archivo)}:{linea}:{func}",
+                                    "llamadas": ncalls, "acumulado_s": round(cumtime, 4)})
+                top_cpu = sorted(top_cpu, key=lambda f: f["acumulado_s"], reverse=True)[:PROFILE_TOP_N]
+
+            registro = {
+                "tool": nombre,
+                "ts": ts,
+                "duracion_s": round(duracion, 3),
+                "error": error,
+                "concurrentes": concurrentes,
+                "pico_python_mb": round(pico / 1024 ** 2, 2),
+                "rss_inicio_mb": round(rss_inicio, 2),
+                "rss_fin_mb": round(rss_actual_mb(), 2),
+                "rss_maximo_mb": round(rss_maximo_mb(), 2),
+                "rss_workers_mb": round(rss_workers, 2),
+                "rss_workers_maximo_mb": round(rss_workers_maximo, 2),
+                "temporales_sin_borrar": sorted(r for r in temporales if os.path.exists(r)),
+                "top_asignaciones": [
+                    {"origen": str(diff.traceback[0]), "kb": round(diff.size_diff / 1024, 1), "bloques": diff.count_diff}
+                    for diff in despues.compare_to(antes, "lineno")[:PROFILE_TOP_N]
+                ],
+                "top_cpu": top_cpu,
+                "perfil_cpu": ruta_prof,
+            }
+            with _lock:
+                _registros.append(registro)
+                with open(os.path.join(PROFILE_DIR, "invocaciones.jsonl"), "a", encoding="utf-8") as f:
+                    f.write(json.dumps(registro, ensure_ascii=False) + "\n")
+            logger.info(f"Perfil de '{nombre}': {registro['duracion_s']}s, pico Python "
+                        f"{registro['pico_python_mb']} MB, RSS {registro['rss_fin_mb']} MB")
+
+    return wrapper
+
+
+def resumen_perfiles(desde=0):
+    """Resumen por tool de las invocaciones perfiladas a partir del índice desde."""
+    with _lock:
+        registros = _registros[desde:]
+        total = len(_registros)
+
+    por_tool = {}
+    for r in registros:
+        t = por_tool.setdefault(r["tool"], {"invocaciones": 0, "errores": 0, "duraciones": [],
+                                            "pico_python_mb": 0.0, "rss_maximo_mb": 0.0,
+                                            "rss_workers_maximo_mb": 0.0, "temporales_sin_borrar": 0})
+        t["invocaciones"] += 1
+        t["errores"] += int(r["error"] is not None)
+        t["duraciones"].append(r["duracion_s"])
+        t["pico_python_mb"] = max(t["pico_python_mb"], r["pico_python_mb"])
+        t["rss_maximo_mb"] = max(t["rss_maximo_mb"], r["rss_maximo_mb"])
+        t["rss_workers_maximo_mb"] = max(t["rss_workers_maximo_mb"], r.get("rss_workers_maximo_mb", 0.0))
+        t["temporales_sin_borrar"] += len(r["temporales_sin_borrar"])
+
+    for t in por_tool.values():
+        duraciones = sorted(t.pop("duraciones"))
+        t["duracion_p50_s"] = duraciones[len(duraciones) // 2]
+        t["duracion_p95_s"] = duraciones[min(len(duraciones) - 1, int(len(duraciones) * 0.95))]
+
+    rss_workers, rss_workers_maximo = memoria_workers_mb()
+    return {
+        "activo": MCP_PROFILING,
+        "registros": total,
+        "rss_actual_mb": round(rss_actual_mb(), 2),
+        "rss_maximo_mb": round(rss_maximo_mb(), 2),
+        "rss_workers_mb": round(rss_workers, 2),
+        "rss_workers_maximo_mb": round(rss_workers_maximo, 2),
+        # Cota superior del pico conjunto: los picos de cada proceso pueden no coincidir en el tiempo
+        "rss_total_maximo_mb": round(rss_maximo_mb() + rss_workers_maximo, 2),
+        "tools": por_tool,
+    }
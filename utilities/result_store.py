@@ -0,0 +1,237 @@
+# utilities/result_store.py - Almacén columnar (Parquet) de resultados de facturas procesadas
+
+import os
+import json
+import time
+import uuid
+import atexit
+import logging
+import threading
+from datetime import datetime, date
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pyarrow import fs
+from utilities.logging_config import correlation_id
+from utilities.parsing import parsear_fecha
+
+logger = logging.getLogger(__name__)
+
+# Directorio local o URI (gs://bucket/ruta) donde se escriben los Parquet
+RESULT_STORE_URI = os.getenv("RESULT_STORE_URI", os.path.abspath("resultados_facturas"))
+RESULT_STORE_BATCH_SIZE = int(os.getenv("RESULT_STORE_BATCH_SIZE", 500))
+RESULT_STORE_FLUSH_SECONDS = float(os.getenv("RESULT_STORE_FLUSH_SECONDS", 60))
+# Filas que se retienen en memoria para reintentar si la escritura falla
+RESULT_STORE_MAX_PENDING = int(os.getenv("RESULT_STORE_MAX_PENDING", 10 * RESULT_STORE_BATCH_SIZE))
+
+SCHEMA = pa.schema([
+    ("ts", pa.timestamp("ms")),
+    ("etapa", pa.string()),
+    ("status", pa.string()),
+    ("documento", pa.string()),
+    ("correlation_id", pa.string()),
+    ("proveedor", pa.string()),
+    ("nit_proveedor", pa.string()),
+    ("proveedor_codigo", pa.string()),
+    ("numero_factura", pa.string()),
+    ("fecha_emision", pa.string()),
+    ("fecha_factura", pa.date32()),
+    ("monto_total", pa.float64()),
+    ("factura_valida", pa.bool_()),
+    ("factura_id_sap", pa.string()),
+    ("error", pa.string()),
+    ("datos_json", pa.string()),
+])
+
+# Particionado por día de procesamiento (fecha=YYYY-MM-DD)
+PARTITIONING = ds.partitioning(pa.schema([("fecha", pa.string())]), flavor="hive")
+
+
+class BufferedResultWriter:
+    """
+    Acumula resultados en memoria y los escribe como Parquet en un hilo de
+    fondo cuando se llena el lote o pasa el intervalo máximo, para que el
+    append no agregue latencia de escritura a la petición.
+    """
+
+    def __init__(self, uri=RESULT_STORE_URI, batch_size=RESULT_STORE_BATCH_SIZE,
+                 flush_seconds=RESULT_STORE_FLUSH_SECONDS, max_pending=RESULT_STORE_MAX_PENDING):
+        self.filesystem, self.base_path = fs.FileSystem.from_uri(uri)
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_pending = max_pending
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="result-store-writer", daemon=True)
+        self._thread.start()
+
+    def append(self, registro):
+        with self._lock:
+            self._buffer.append(registro)
+            lleno = len(self._buffer) >= self.batch_size
+        if lleno:
+            self._wake.set()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            registros, self._buffer = self._buffer, []
+        if not registros:
+            return
+
+        with self._write_lock:
+            por_fecha = {}
+            for r in registros:
+                por_fecha.setdefault(r["ts"].strftime("%Y-%m-%d"), []).append(r)
+
+            escritos = 0
+            pendientes = []
+            for fecha, filas in por_fecha.items():
+                try:
+                    directorio = f"{self.base_path}/fecha={fecha}"
+                    self.filesystem.create_dir(directorio, recursive=True)
+                    tabla = pa.Table.from_pylist(filas, schema=SCHEMA)
+                    nombre = f"{directorio}/part-{int(time.time())}-{uuid.uuid4().hex[:8]}.parquet"
+                    pq.write_table(tabla, nombre, filesystem=self.filesystem, compression="zstd")
+                    escritos += len(filas)
+                except Exception as e:
+                    logger.error(f"No se pudieron escribir {len(filas)} resultados en Parquet ({fecha}): {e}")
+                    pendientes.extend(filas)
+
+            if escritos:
+                logger.info(f"{escritos} resultados de facturas escritos en Parquet")
+            if pendientes:
+                self._reencolar(pendientes)
+
+    def _reencolar(self, pendientes):
+        """Devuelve al buffer las filas no escritas, descartando las más antiguas por encima de max_pending."""
+        with self._lock:
+            self._buffer = pendientes + self._buffer
+            exceso = len(self._buffer) - self.max_pending
+            if exceso > 0:
+                self._buffer = self._buffer[exceso:]
+        if exceso > 0:
+            logger.error(f"Buffer de resultados lleno: se descartan {exceso} resultados sin escribir")
+        else:
+            logger.warning(f"{len(pendientes)} resultados se reintentarán en la próxima escritura")
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        self._thread.join(timeout=self.flush_seconds + 5)
+        self.flush()
+
+
+def _texto(valor):
+    if valor is None:
+        return None
+    texto = str(valor).strip()
+    return None if texto.lower().startswith("no detectad") else texto
+
+
+def _monto(valor):
+    try:
+        return float(valor)
+    except (TypeError, ValueError):
+        return None
+
+
+def registrar_resultado(etapa, status, documento=None, datos=None, proveedor_codigo=None,
+                        factura_id_sap=None, error=None, monto_total=None):
+    """
+    Agrega un resultado al almacén. etapa es "validacion" o "sap"; datos puede
+    venir en el formato de validar_factura_tool o en el de extraer_datos_factura_desde_texto.
+    Nunca propaga errores: un fallo del almacén no debe afectar a la factura.
+    """
+    try:
+        get_result_writer().append(armar_registro(etapa, status, documento, datos or {}, proveedor_codigo,
+                                                  factura_id_sap, error, monto_total))
+    except Exception as e:
+        logger.error(f"No se pudo registrar el resultado de la factura: {e}")
+
+
+def armar_registro(etapa, status, documento, datos, proveedor_codigo, factura_id_sap, error, monto_total):
+    if monto_total is None:
+        monto_total = _monto(datos.get("InvoiceGrossAmount", datos.get("monto_total")))
+    return {
+        "ts": datetime.now(),
+        "etapa": etapa,
+        "status": status,
+        "documento": documento,
+        "correlation_id": correlation_id.get(),
+        "proveedor": _texto(datos.get("empresa_emisora") or datos.get("SupplierName")),
+        "nit_proveedor": _texto(datos.get("nit_factura") or datos.get("SupplierTaxNumber")),
+        "proveedor_codigo": proveedor_codigo,
+        "numero_factura": _texto(datos.get("numero_factura") or datos.get("SupplierInvoiceIDByInvcgParty")),
+        "fecha_emision": _texto(datos.get("fecha_emision") or datos.get("DocumentDate")),
+        "fecha_factura": parsear_fecha(datos.get("fecha_emision") or datos.get("DocumentDate")),
+        "monto_total": monto_total,
+        "factura_valida": datos.get("factura_valida"),
+        "factura_id_sap": factura_id_sap,
+        "error": error,
+        "datos_json": json.dumps(datos, ensure_ascii=False, default=str),
+    }
+
+
+def consultar_resultados(proveedor=None, desde=None, hasta=None, status=None, etapa=None,
+                         factura_desde=None, factura_hasta=None, columnas=None, uri=RESULT_STORE_URI):
+    """
+    Lee los resultados filtrando por proveedor (nombre exacto, NIT o código SAP),
+    rango de fechas de procesamiento (date o 'YYYY-MM-DD'), rango de fechas de
+    emisión de la factura (factura_desde/factura_hasta), status y etapa.
+    El filtro de fecha de procesamiento poda particiones completas; el resto se empuja a Parquet.
+    """
+    filesystem, base_path = fs.FileSystem.from_uri(uri)
+    dataset = ds.dataset(base_path, filesystem=filesystem, format="parquet",
+                         schema=SCHEMA.append(pa.field("fecha", pa.string())),
+                         partitioning=PARTITIONING)
+
+    filtro = None
+
+    def y(expr):
+        nonlocal filtro
+        filtro = expr if filtro is None else filtro & expr
+
+    if desde:
+        y(ds.field("fecha") >= (desde.isoformat() if isinstance(desde, date) else desde))
+    if hasta:
+        y(ds.field("fecha") <= (hasta.isoformat() if isinstance(hasta, date) else hasta))
+    if factura_desde:
+        y(ds.field("fecha_factura") >= (factura_desde if isinstance(factura_desde, date)
+                                        else date.fromisoformat(factura_desde)))
+    if factura_hasta:
+        y(ds.field("fecha_factura") <= (factura_hasta if isinstance(factura_hasta, date)
+                                        else date.fromisoformat(factura_hasta)))
+    if proveedor:
+        y((ds.field("proveedor") == proveedor)
+          | (ds.field("nit_proveedor") == proveedor)
+          | (ds.field("proveedor_codigo") == proveedor))
+    if status:
+        y(ds.field("status") == status)
+    if etapa:
+        y(ds.field("etapa") == etapa)
+
+    return dataset.to_table(columns=columnas, filter=filtro)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_result_writer():
+    """Writer compartido por el proceso; se vacía al salir."""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = BufferedResultWriter()
+                atexit.register(_writer.close)
+    return _writer
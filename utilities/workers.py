@@ -0,0 +1,119 @@
+# utilities/workers.py - Pool de procesos para trabajo CPU (rasterización y codificación de imágenes)
+
+import io
+import os
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from pdf2image import convert_from_path
+
+logger = logging.getLogger(__name__)
+
+# 0 desactiva el pool y ejecuta en el hilo que llama
+CPU_WORKERS = os.getenv("CPU_WORKERS")
+JPEG_QUALITY = int(os.getenv("OCR_JPEG_QUALITY", 75))
+# Páginas rasterizándose por adelantado mientras se hace OCR de la actual
+OCR_RENDER_WINDOW = int(os.getenv("OCR_RENDER_WINDOW", 4))
+
+
+def available_cpus():
+    """vCPUs del contenedor, respetando la cuota de cgroups (Cloud Run) y la afinidad."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    # cgroup v2: "max 100000" o "200000 100000"
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+
+    return max(1, cpus)
+
+
+def render_pdf_pages(path_doc, first_page=None, last_page=None, dpi=200):
+    """Rasteriza las páginas indicadas y las devuelve codificadas en JPEG (bytes)."""
+    pages = convert_from_path(path_doc, dpi=dpi, first_page=first_page, last_page=last_page)
+    encoded = []
+    for page_image in pages:
+        buffered = io.BytesIO()
+        page_image.save(buffered, format="JPEG", quality=JPEG_QUALITY)
+        encoded.append(buffered.getvalue())
+        page_image.close()
+    return encoded
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def pool_size():
+    return available_cpus() if CPU_WORKERS is None else int(CPU_WORKERS)
+
+
+def _noop():
+    return None
+
+
+def get_process_pool():
+    """
+    Pool de procesos compartido, dimensionado a los vCPUs del contenedor (None si
+    está desactivado). Los workers salen de un proceso forkserver limpio y no de un
+    fork del servidor, que ya tiene hilos (gRPC, GCS, logging) en marcha.
+    """
+    global _pool
+    if pool_size() <= 0:
+        return None
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                logger.info(f"Iniciando pool de procesos CPU con {pool_size()} workers")
+                contexto = multiprocessing.get_context("forkserver")
+                contexto.set_forkserver_preload([__name__])
+                _pool = ProcessPoolExecutor(max_workers=pool_size(), mp_context=contexto)
+    return _pool
+
+
+def warm_process_pool():
+    """Crea el pool y arranca sus workers con tareas vacías, para no pagarlo en la primera petición."""
+    pool = get_process_pool()
+    if pool is None:
+        return 0
+    for future in [pool.submit(_noop) for _ in range(pool_size())]:
+        future.result()
+    logger.info(f"Pool de procesos CPU listo ({pool_size()} workers)")
+    return pool_size()
+
+
+def worker_pids():
+    """PIDs de los workers vivos del pool (vacío si aún no existe o está desactivado)."""
+    pool = _pool
+    if pool is None:
+        return []
+    return list(getattr(pool, "_processes", None) or {})
+
+
+def submit_cpu_bound(func, *args, **kwargs):
+    """Envía func al pool de procesos y devuelve el Future (ya resuelto si el pool está desactivado)."""
+    pool = get_process_pool()
+    if pool is None:
+        future = Future()
+        try:
+            future.set_result(func(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+    return pool.submit(func, *args, **kwargs)
+
+
+def shutdown_process_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True, cancel_futures=True)
+            _pool = None